@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_message_construction
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Measure how many :class:`sender.Message` instances are built per second,
+    and the cost of the Message-ID generators.
+
+    Usage::
+
+        $ python benchmarks/bench_message_construction.py [count]
+
+    :copyright: (c) 2016 by Shipeng Feng.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import time
+from email.utils import make_msgid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sender import Message, make_message_id
+
+
+def rate(func, count):
+    start = time.time()
+    for i in range(count):
+        func(i)
+    return count / (time.time() - start)
+
+
+def main(count=100000):
+    # the domain lookup happens once, keep it out of the measurements
+    make_message_id()
+    print('%d runs' % count)
+    cases = [
+        ('Message()', lambda i: Message(
+            'Hello', to='user%d@example.com' % i, body='Hello world',
+            fromaddr='from@example.com')),
+        ('Message() + id', lambda i: Message(
+            'Hello', to='user%d@example.com' % i, body='Hello world',
+            fromaddr='from@example.com').message_id),
+        ('make_msgid()', lambda i: make_msgid()),
+        ('make_message_id()', lambda i: make_message_id()),
+    ]
+    for name, func in cases:
+        print('%-18s %12.0f per second' % (name, rate(func, count)))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_message_memory
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Measure the memory cost of one queued message, for a list of
+    :class:`sender.Message` instances and for one :class:`sender.MessageBatch`.
+
+    Usage::
+
+        $ python benchmarks/bench_message_memory.py [count]
+
+    :copyright: (c) 2016 by Shipeng Feng.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sender import Message, MessageBatch
+
+
+SUBJECT = 'Monthly newsletter'
+BODY = 'Hello,\n\nhere is what happened this month.\n' * 20
+HTML = '<p>Hello,</p><p>here is what happened this month.</p>' * 20
+FROMADDR = ('Newsletter', 'news@example.com')
+
+
+def recipients(count):
+    return ['user%d@example.com' % i for i in range(count)]
+
+
+def queue_messages(addresses):
+    return [Message(SUBJECT, to=to, body=BODY, html=HTML, fromaddr=FROMADDR)
+            for to in addresses]
+
+
+def queue_batch(addresses):
+    message = Message(SUBJECT, body=BODY, html=HTML, fromaddr=FROMADDR)
+    return MessageBatch(message, addresses)
+
+
+def measure(build, addresses):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        queue = build(addresses)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del queue
+    return float(after - before) / len(addresses)
+
+
+def main(count=200000):
+    addresses = recipients(count)
+    print('%d queued messages' % count)
+    for name, build in [('Message list', queue_messages),
+                        ('MessageBatch', queue_batch)]:
+        print('%-14s %10.1f bytes/message' % (name,
+                                              measure(build, addresses)))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
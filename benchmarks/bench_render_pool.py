@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_render_pool
+    ~~~~~~~~~~~~~~~~~
+
+    Measure the speedup of rendering messages in worker processes, see the
+    ``render_processes`` parameter of :meth:`sender.Mail.send`.  HTML
+    messages with one attachment are rendered with 1, 2, 4, ... processes
+    up to the number of cores, once on their own and once while they are
+    sent over a few connections to the local :mod:`smtpsink` server.
+
+    Usage::
+
+        $ python benchmarks/bench_render_pool.py [count]
+
+    :copyright: (c) 2016 by Shipeng Feng.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import time
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sender import Mail, Message, Attachment
+from smtpsink import SMTPSink
+
+
+FROMADDR = ('Newsletter', 'news@example.com')
+BODY = u'Hello,\n\nhere is what happened this month.\n' * 40
+HTML = u'<p>Hello,</p><p>here is what happened this month.</p>' * 40
+ATTACHMENT = bytes(bytearray(range(256))) * 64
+
+
+def make(i):
+    msg = Message(u'Monthly newsletter — %d' % i,
+                  to='user%d@example.com' % i, body=BODY, html=HTML,
+                  fromaddr=FROMADDR)
+    msg.attach(Attachment('report.bin', 'application/octet-stream',
+                          ATTACHMENT))
+    return msg
+
+
+def render(mail, count, processes):
+    messages = (make(i) for i in range(count))
+    start = time.time()
+    if processes:
+        messages = mail._render_ahead(messages, processes)
+    for message in messages:
+        mail.prepare(message)
+        message.as_bytes()
+    return count / (time.time() - start)
+
+
+def send(mail, count, processes):
+    start = time.time()
+    mail.send((make(i) for i in range(count)), concurrency=4,
+              render_processes=processes)
+    return count / (time.time() - start)
+
+
+def main(count=2000):
+    cores = multiprocessing.cpu_count()
+    sink = SMTPSink()
+    sink.start()
+    mail = Mail('127.0.0.1', port=sink.port)
+    print('%d messages, %d cores' % (count, cores))
+    print('%-10s%12s%10s%12s%10s' % ('processes', 'render/s', 'speedup',
+                                     'send/s', 'speedup'))
+    try:
+        base_render = render(mail, count, None)
+        base_send = send(mail, count, None)
+        print('%-10s%12.1f%10s%12.1f%10s' % ('none', base_render, '-',
+                                             base_send, '-'))
+        processes = 1
+        while processes <= cores:
+            rendered = render(mail, count, processes)
+            sent = send(mail, count, processes)
+            print('%-10d%12.1f%9.2fx%12.1f%9.2fx' % (
+                processes, rendered, rendered / base_render,
+                sent, sent / base_send))
+            processes *= 2
+    finally:
+        sink.stop()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
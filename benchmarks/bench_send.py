@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_send
+    ~~~~~~~~~~
+
+    Measure rendering and sending throughput against the local
+    :mod:`smtpsink` server, for a few typical kinds of messages: messages
+    per second, p50/p99 latency of one send, memory allocated while building
+    and rendering one message, and the resident set size.
+
+    The inputs are fixed and every scenario keeps its best of a few runs, so
+    the numbers of two commits can be compared::
+
+        $ python benchmarks/bench_send.py --json before.json
+        $ git checkout other-branch
+        $ python benchmarks/bench_send.py --compare before.json
+
+    Usage::
+
+        $ python benchmarks/bench_send.py [-n count] [-r repeat]
+                                          [--renderer fast] [scenario ...]
+
+    :copyright: (c) 2016 by Shipeng Feng.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import gc
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sender import Mail, Message, Attachment
+from smtpsink import SMTPSink
+
+
+FROMADDR = ('Newsletter', 'news@example.com')
+BODY = u'Hello,\n\nhere is what happened this month.\n' * 40
+HTML = u'<p>Hello,</p><p>here is what happened this month.</p>' * 40
+ATTACHMENT = bytes(bytearray(range(256))) * 4096
+
+
+def plain(i):
+    return Message('Monthly newsletter', to='user%d@example.com' % i,
+                   body=BODY, fromaddr=FROMADDR)
+
+
+def html(i):
+    return Message('Monthly newsletter', to='user%d@example.com' % i,
+                   body=BODY, html=HTML, fromaddr=FROMADDR)
+
+
+def many_recipients(i):
+    return Message('Monthly newsletter', body=BODY, fromaddr=FROMADDR,
+                   to=['user%d@example.com' % n for n in range(20)],
+                   bcc=['user%d-%d@example.com' % (i, n)
+                        for n in range(180)])
+
+
+def attachment(i):
+    msg = Message('Monthly report', to='user%d@example.com' % i, body=BODY,
+                  fromaddr=FROMADDR)
+    msg.attach(Attachment('report.bin', 'application/octet-stream',
+                          ATTACHMENT))
+    return msg
+
+
+def non_ascii(i):
+    return Message(u'Monatsbericht — 月度报告',
+                   to=(u'B\xe9n\xe9dicte %d' % i, 'user%d@example.com' % i),
+                   cc=[(u'张三', 'zhang@example.com')],
+                   body=u'Gr\xfc\xdfe aus K\xf6ln, 你好。\n' * 40,
+                   fromaddr=(u'发件人', 'from@example.com'))
+
+
+#: name, message factory and share of the base count
+SCENARIOS = OrderedDict([
+    ('plain', (plain, 1)),
+    ('html+text', (html, 1)),
+    ('200 recipients', (many_recipients, 0.2)),
+    ('1 MB attachment', (attachment, 0.02)),
+    ('non-ascii', (non_ascii, 1)),
+])
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def rss():
+    """The resident set size in KB."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (IOError, OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def render_rate(mail, make, count):
+    start = time.time()
+    for i in range(count):
+        message = make(i)
+        mail.prepare(message)
+        message.as_bytes()
+    return count / (time.time() - start)
+
+
+def allocated(mail, make, count=20):
+    """Peak bytes allocated while building and rendering one message."""
+    render_rate(mail, make, 1)
+    gc.collect()
+    peaks = []
+    for i in range(count):
+        tracemalloc.start()
+        try:
+            message = make(i)
+            mail.prepare(message)
+            message.as_bytes()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    return percentile(peaks, 0.5)
+
+
+def send(mail, make, count):
+    latencies = []
+    start = time.time()
+    with mail.connection as c:
+        for i in range(count):
+            message = make(i)
+            mail.prepare(message)
+            t = time.time()
+            c.send(message)
+            latencies.append(time.time() - t)
+    elapsed = time.time() - start
+    return count / elapsed, latencies
+
+
+def run(names, count, repeat=3, renderer='email'):
+    sink = SMTPSink()
+    sink.start()
+    mail = Mail('127.0.0.1', port=sink.port, renderer=renderer)
+    results = OrderedDict()
+    try:
+        for name in names:
+            make, share = SCENARIOS[name]
+            n = max(10, int(count * share))
+            rate, latencies = max(send(mail, make, n) for i in range(repeat))
+            results[name] = OrderedDict([
+                ('messages', n),
+                ('render/s', max(render_rate(mail, make, n)
+                                 for i in range(repeat))),
+                ('send/s', rate),
+                ('p50 ms', percentile(latencies, 0.5) * 1000),
+                ('p99 ms', percentile(latencies, 0.99) * 1000),
+                ('alloc KB', allocated(mail, make) / 1024.0),
+                ('rss MB', rss() / 1024.0),
+            ])
+    finally:
+        sink.stop()
+    return results
+
+
+def describe():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return OrderedDict([('commit', commit),
+                        ('python', platform.python_version()),
+                        ('platform', platform.platform())])
+
+
+def report(results, baseline=None):
+    columns = list(next(iter(results.values())))[1:]
+    print('%-16s' % 'scenario' + ''.join('%12s' % c for c in columns))
+    for name, values in results.items():
+        print('%-16s' % name +
+              ''.join('%12.1f' % values[c] for c in columns))
+        old = (baseline or {}).get(name)
+        if old:
+            print('%-16s' % '  change' + ''.join(
+                '%11.1f%%' % ((values[c] / old[c] - 1) * 100)
+                if old.get(c) else '%12s' % '-' for c in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='one of %s' % ', '.join(SCENARIOS))
+    parser.add_argument('-n', '--count', type=int, default=2000,
+                        help='messages of the plain scenario')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs of every scenario, the best one is kept')
+    parser.add_argument('--renderer', choices=['email', 'fast'],
+                        default='email', help='how messages are rendered')
+    parser.add_argument('--json', metavar='FILE',
+                        help='save the results to FILE')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='show the change against the results in FILE')
+    args = parser.parse_args(argv)
+    names = args.scenarios or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario %r' % name)
+
+    meta = describe()
+    print('commit %(commit)s, Python %(python)s, %(platform)s' % meta)
+    results = run(names, args.count, args.repeat, args.renderer)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        print('compared with commit %s' % saved['meta']['commit'])
+        baseline = saved['results']
+    report(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+    smtpsink
+    ~~~~~~~~
+
+    A local SMTP server that accepts every message and throws it away, so
+    that benchmarks measure the client and not the server.  It speaks ESMTP
+    with ``PIPELINING``, ``SIZE`` and ``8BITMIME``.
+
+    Usage::
+
+        $ python benchmarks/smtpsink.py [port]
+
+    Or in process::
+
+        sink = SMTPSink()
+        sink.start()
+        ...
+        sink.stop()
+
+    :copyright: (c) 2016 by Shipeng Feng.
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import threading
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+EHLO_REPLY = (b'250-localhost\r\n'
+              b'250-PIPELINING\r\n'
+              b'250-SIZE 104857600\r\n'
+              b'250 8BITMIME\r\n')
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    """One SMTP session."""
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        rfile, wfile = self.rfile, self.wfile
+        wfile.write(b'220 localhost smtpsink\r\n')
+        messages = data_bytes = 0
+        for line in rfile:
+            verb = line[:4].upper()
+            if verb == b'EHLO':
+                wfile.write(EHLO_REPLY)
+            elif verb == b'DATA':
+                wfile.write(b'354 go ahead\r\n')
+                for line in rfile:
+                    if line == b'.\r\n':
+                        break
+                    data_bytes += len(line)
+                messages += 1
+                wfile.write(b'250 queued\r\n')
+            elif verb == b'QUIT':
+                wfile.write(b'221 bye\r\n')
+                break
+            else:
+                wfile.write(b'250 ok\r\n')
+        self.server.count(messages, data_bytes)
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """The sink server, listening on 127.0.0.1.
+
+    :param port: the port, default to be 0 which means any free one
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, port=0):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', port),
+                                                 SinkHandler)
+        self.lock = threading.Lock()
+        #: messages and bytes of message data received in closed sessions
+        self.messages = 0
+        self.bytes = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def count(self, messages, data_bytes):
+        with self.lock:
+            self.messages += messages
+            self.bytes += data_bytes
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main(port=2525):
+    sink = SMTPSink(port)
+    print('smtpsink listening on 127.0.0.1:%d' % sink.port)
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.server_close()
+        print('%d messages, %d bytes' % (sink.messages, sink.bytes))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
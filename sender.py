@@ -11,16 +11,51 @@
 
 __version__ = '0.3'
 
+import re
 import sys
+import os
+import json
+import pickle
+import mmap
+import random
+import socket
+import itertools
+import heapq
+import hashlib
+import string
 import smtplib
+import sqlite3
+import threading
 import time
+import uuid
+import weakref
+from io import BytesIO
+from collections import OrderedDict, deque
 from email import charset
 from email.encoders import encode_base64
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from email.utils import make_msgid, formataddr, parseaddr, formatdate
+from email.utils import formataddr, parseaddr, formatdate, quote, \
+    encode_rfc2231
 from email.header import Header
+try:
+    from email.generator import BytesGenerator
+except ImportError:
+    BytesGenerator = None
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+from email.charset import Charset
+try:
+    from base64 import encodebytes
+except ImportError:
+    from base64 import encodestring as encodebytes
 
 
 charset.add_charset('utf-8', charset.SHORTEST, None, 'utf-8')
@@ -49,7 +84,9 @@ class Mail(object):
     """Sender Mail main class.  This class is used for manage SMTP server
     connections and send messages.
 
-    :param host: smtp server host, default to be 'localhost'
+    :param host: smtp server host, default to be 'localhost', or a list of
+                 hosts, ``(host, port)`` or ``(host, port, weight)`` tuples
+                 to spread the connections over, see :class:`HostList`
     :param username: smtp server authentication username
     :param password: smtp server authentication password
     :param port: smtp server port, default to be 25
@@ -58,48 +95,723 @@ class Mail(object):
     :param use_ssl: put the SMTP connection in SSL mode, default to be False
     :param debug_level: the debug output level
     :param fromaddr: default sender for all messages sent by this mail instance
+    :param pool_size: keep up to this many logged-in SMTP sessions open and
+                      reuse them between sends, default to be None which
+                      means every connection is opened and closed again
+    :param pool_idle_timeout: seconds one pooled session may stay idle before
+                              it is closed, default to be None (forever)
+    :param pool_timeout: seconds to wait for a free pooled session when all
+                         of them are in use, default to be None (forever)
+    :param max_connections: the most simultaneous sessions the server
+                            allows, caps the concurrency of :meth:`send`
+    :param message_id_domain: domain of the Message-ID of messages sent by
+                              this mail instance, default to be None which
+                              means the fully qualified name of this host
+    :param spool_path: path of one SQLite file used as durable outbound
+                       queue by :meth:`enqueue`
+    :param spool_workers: number of background threads delivering the
+                          queued messages, default to be 1
+    :param retry: one :class:`RetryPolicy` instance, transient failures are
+                  then tried again later and :meth:`send` returns one
+                  :class:`SendResult` for each message instead of raising
+    :param rate_limiter: one :class:`RateLimiter` instance pacing the
+                         messages, recipients and connections, it may be
+                         shared by several mail instances
+    :param max_recipients: the most recipients of one SMTP transaction,
+                           bigger envelopes are split, default to be None
+                           (no limit)
+    :param host_cooldown: seconds one failing host is left out, default to
+                          be 30
+    :param resolve_mx: the hosts are mail domains, connect to the servers
+                       of their MX records, default to be False
+    :param mx_resolver: one function returning ``(preference, host)`` pairs
+                        for one domain, default to be :func:`lookup_mx`
+    :param direct: deliver straight to the MX servers of the recipient
+                   domains instead of through ``host``, see :meth:`send`
+    :param metrics: one :class:`Metrics` instance receiving the durations
+                    of the send phases and the outcomes, default to be one
+                    that ignores them
+    :param renderer: how messages are rendered, ``'email'`` (the default)
+                     builds them with the :mod:`email` package, ``'fast'``
+                     writes the same bytes directly, see :func:`fast_render`
     """
 
     def __init__(self, host='localhost', username=None, password=None,
                  port=25, use_tls=False, use_ssl=False, debug_level=None,
-                 fromaddr=None):
+                 fromaddr=None, pool_size=None, pool_idle_timeout=None,
+                 pool_timeout=None, max_connections=None,
+                 message_id_domain=None, spool_path=None, spool_workers=1,
+                 retry=None, rate_limiter=None, max_recipients=None,
+                 host_cooldown=30.0, resolve_mx=False, mx_resolver=None,
+                 direct=False, metrics=None, renderer='email'):
         self.host = host
         self.port = port
+        self.hosts = HostList(host, port, host_cooldown, resolve_mx,
+                              mx_resolver)
+        self.host_cooldown = host_cooldown
+        self.mx_resolver = mx_resolver
+        self.direct = direct
+        # the MX servers of the recipient domains, for direct delivery
+        self._domains = {}
+        self._domains_lock = threading.Lock()
         self.username = username
         self.password = password
         self.use_tls = use_tls
         self.use_ssl = use_ssl
         self.debug_level = debug_level
         self.fromaddr = fromaddr
+        self.max_connections = max_connections
+        self.retry = retry
+        self.rate_limiter = rate_limiter
+        self.max_recipients = max_recipients
+        self.metrics = metrics if metrics is not None else null_metrics
+        if renderer not in ('email', 'fast'):
+            raise SenderError('unknown renderer %r' % (renderer,))
+        self.renderer = renderer
+        if message_id_domain is not None:
+            self.make_message_id = MessageIDGenerator(message_id_domain)
+        else:
+            self.make_message_id = make_message_id
+        if pool_size:
+            self.pool = ConnectionPool(self, pool_size, pool_idle_timeout,
+                                       pool_timeout)
+        else:
+            self.pool = None
+        if direct and (self.pool is not None or retry is not None):
+            raise SenderError('direct delivery does not support connection '
+                              'pooling and retries')
+        if spool_path is not None:
+            self.spool = Spool(self, spool_path, spool_workers)
+        else:
+            self.spool = None
 
     @property
     def connection(self):
-        """Open one connection to the SMTP server.
+        """Open one connection to the SMTP server.  If this mail instance
+        has a connection pool, the connection borrows one pooled session.
         """
         return Connection(self)
 
-    def send(self, message_or_messages):
-        """Sends a single messsage or multiple messages.
+    def close(self):
+        """Stop the spool workers and close all idle pooled sessions.
+        """
+        if self.spool is not None:
+            self.spool.close()
+        if self.pool is not None:
+            self.pool.close()
+
+    def enqueue(self, message):
+        """Stores one message in the spool and returns at once, the message
+        is delivered by the background workers.  Returns the spool id.
+
+        :param message: one message instance
+        """
+        if self.spool is None:
+            raise SenderError('enqueue needs a spool, set spool_path')
+        self.prepare(message)
+        return self.spool.put(message)
+
+    def send(self, message_or_messages, concurrency=None,
+             render_processes=None):
+        """Sends a single messsage or multiple messages.  Returns the
+        result of :meth:`Connection.send` for one message, or a list of them
+        in the same order for multiple messages.
+
+        For direct delivery, the recipients of every message are grouped by
+        domain, and each domain gets one transaction sent to its MX servers.
+        The domains are delivered in parallel, and the sessions to one MX
+        server are reused for all the domains it serves.  Failures of one
+        domain do not stop the others, they are reported in the results.
+
+        With ``render_processes``, messages are pickled and rendered in a
+        pool of worker processes, a few messages ahead of the ones being
+        sent, so rendering is not bound to one core.  Messages that can not
+        be pickled, such as the ones with streamed attachments, are rendered
+        here as usual.
 
         :param message_or_messages: one message instance or one iterable of
                                     message instances.
+        :param concurrency: send over up to this many connections in
+                            parallel threads, default to be None which means
+                            all messages go down one connection, or up to
+                            10 domains at once for direct delivery
+        :param render_processes: render in this many worker processes,
+                                 default to be None which means messages
+                                 are rendered in the sending threads
         """
         try:
             messages = iter(message_or_messages)
         except TypeError:
-            messages = [message_or_messages]
-
+            return self.send([message_or_messages], concurrency,
+                             render_processes)[0]
+
+        if render_processes:
+            if ProcessPoolExecutor is None:
+                raise SenderError('render_processes needs the '
+                                  'concurrent.futures module')
+            messages = self._render_ahead(messages, render_processes)
+        if self.direct:
+            return self._send_direct(messages, concurrency or 10)
+        if self.retry is not None:
+            return self._send_retrying(messages, concurrency or 1)
+        if concurrency is not None and concurrency > 1:
+            return self._send_parallel(messages, concurrency)
+
+        results = []
         with self.connection as c:
             for message in messages:
-                if self.fromaddr and not message.fromaddr:
-                    message.fromaddr = self.fromaddr
-                message.validate()
-                c.send(message)
+                self.prepare(message)
+                results.append(c.send(message))
+        return results
+
+    def _send_parallel(self, messages, concurrency):
+        if self.max_connections is not None:
+            concurrency = min(concurrency, self.max_connections)
+        lock = threading.Lock()
+        messages = enumerate(messages)
+        if self.max_recipients:
+            # the chunks of one big envelope may go down several connections
+            messages = ((index, envelope) for index, message in messages
+                        for envelope in self._split(message))
+        # messages given back by workers that could not connect
+        pending = []
+        results = {}
+        errors = []
+        split = set()
+
+        def store(connection, index, message):
+            if not isinstance(message, Envelope):
+                results[index] = connection.send(message)
+                return
+            try:
+                sent = connection.send(message)
+            except smtplib.SMTPRecipientsRefused as e:
+                sent = SendResult(message)
+                sent.refused = e.recipients
+            with lock:
+                if index not in split:
+                    split.add(index)
+                    results[index] = SendResult(message.message)
+                results[index].merge(sent)
+
+        def next_message():
+            with lock:
+                if errors:
+                    return None
+                if pending:
+                    return pending.pop()
+                try:
+                    return next(messages)
+                except StopIteration:
+                    return None
+                except Exception as e:
+                    errors.append(e)
+                    return None
+
+        def work():
+            item = next_message()
+            if item is None:
+                return
+            try:
+                with self.connection as c:
+                    while item is not None:
+                        index, message = item
+                        self.prepare(message)
+                        store(c, index, message)
+                        item = next_message()
+            except smtplib.SMTPConnectError:
+                # the server limits simultaneous sessions, leave the work
+                # to the other connections
+                with lock:
+                    pending.append(item)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+        workers = [threading.Thread(target=work) for i in range(concurrency)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+        if pending:
+            # every other connection was gone before picking these up, send
+            # them and the rest over one connection
+            with self.connection as c:
+                item = next_message()
+                while item is not None:
+                    index, message = item
+                    self.prepare(message)
+                    store(c, index, message)
+                    item = next_message()
+            if errors:
+                raise errors[0]
+        for index in sorted(split):
+            if not results[index].accepted:
+                raise smtplib.SMTPRecipientsRefused(results[index].refused)
+        return [results[i] for i in sorted(results)]
+
+    def _render_ahead(self, messages, processes):
+        # keeps the workers busy with the messages after the ones being sent
+        window = deque()
+        with ProcessPoolExecutor(processes) as executor:
+            for message in messages:
+                try:
+                    if callable(message):
+                        message = message()
+                    self.prepare(message)
+                except SenderError:
+                    # made or prepared again while it is sent, where the
+                    # error belongs
+                    window.append((message, None))
+                else:
+                    window.append((message,
+                                   _submit_render(executor, message)))
+                if len(window) > processes * 2:
+                    yield _rendered(*window.popleft())
+            while window:
+                yield _rendered(*window.popleft())
+
+    def _split(self, message):
+        self.prepare(message)
+        envelopes = split_recipients(message, self.max_recipients)
+        return envelopes if len(envelopes) > 1 else [message]
+
+    def _send_direct(self, messages, concurrency):
+        results = []
+        domains = OrderedDict()
+        for index, message in enumerate(messages):
+            self.prepare(message)
+            results.append(SendResult(message))
+            for domain, to_addrs in iteritems(group_by_domain(
+                    message.to_addrs)):
+                domains.setdefault(domain, []).append(
+                    (index, Envelope(message, to_addrs)))
+        if self.max_connections is not None:
+            concurrency = min(concurrency, self.max_connections)
+        lock = threading.Lock()
+        domains = iter(list(iteritems(domains)))
+        # idle sessions by MX server, shared by the domains it serves
+        idle = {}
+
+        def checkout(hosts):
+            with lock:
+                for endpoint in hosts.candidates():
+                    sessions = idle.get((endpoint.host, endpoint.port))
+                    if sessions:
+                        return sessions.pop()
+            return Connection(self, hosts).__enter__()
+
+        def checkin(connection):
+            limiter = self.rate_limiter
+            if limiter is not None and limiter.max_connections is not None:
+                # an idle session would keep its connection slot, and the
+                # workers waiting for one would never get it
+                connection.__exit__(None, None, None)
+                return
+            endpoint = connection.server.endpoint
+            with lock:
+                idle.setdefault((endpoint.host, endpoint.port),
+                                []).append(connection)
+
+        def failed(envelope, error):
+            sent = SendResult(envelope)
+            sent.error = error
+            sent.refused = refused_by(error, envelope.to_addrs)
+            return sent
+
+        def record(index, sent):
+            with lock:
+                results[index].merge(sent)
+                if sent.error is not None:
+                    results[index].error = sent.error
+
+        def deliver(domain, envelopes):
+            hosts = self._mx_hosts(domain)
+            try:
+                hosts.endpoints
+            except Exception as e:
+                # NXDOMAIN, timeouts and whatever one custom resolver
+                # raises, none of the recipients of this domain is reachable
+                for index, envelope in envelopes:
+                    record(index, failed(envelope, e))
+                return
+            connection = None
+            for index, envelope in envelopes:
+                try:
+                    if connection is None:
+                        connection = checkout(hosts)
+                    sent = connection.send(envelope)
+                except smtplib.SMTPRecipientsRefused as e:
+                    sent = SendResult(envelope)
+                    sent.refused = e.recipients
+                except (smtplib.SMTPException, socket.error) as e:
+                    sent = failed(envelope, e)
+                    if connection is not None and is_broken(e):
+                        connection.__exit__(type(e), e, None)
+                        connection = None
+                record(index, sent)
+            if connection is not None:
+                checkin(connection)
+
+        def work():
+            while True:
+                with lock:
+                    try:
+                        domain, envelopes = next(domains)
+                    except StopIteration:
+                        return
+                deliver(domain, envelopes)
+
+        workers = [threading.Thread(target=work)
+                   for i in range(concurrency - 1)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            work()
+        finally:
+            for worker in workers:
+                worker.join()
+            for connections in itervalues(idle):
+                for connection in connections:
+                    connection.__exit__(None, None, None)
+        for result in results:
+            result.attempts = 1
+            if result.accepted:
+                result.error = None
+            elif result.error is None:
+                result.error = smtplib.SMTPRecipientsRefused(result.refused)
+        return results
+
+    def _mx_hosts(self, domain):
+        with self._domains_lock:
+            hosts = self._domains.get(domain)
+            if hosts is None:
+                hosts = HostList(domain, self.port, self.host_cooldown,
+                                 resolve_mx=True, resolver=self.mx_resolver)
+                self._domains[domain] = hosts
+        return hosts
+
+    def _send_retrying(self, messages, concurrency):
+        results = {}
+        delivery = _Delivery(self, messages, concurrency, self.retry,
+                            results.__setitem__)
+        delivery.run()
+        return [results[i] for i in sorted(results)]
+
+    def stream(self, messages, concurrency=None, window=100,
+               render_processes=None):
+        """Sends the messages of one iterable, which may be one lazy
+        iterator over millions of them, and yields one :class:`SendResult`
+        for each as soon as it is done, so the results come in completion
+        order.  At most ``window`` messages are taken from the iterable and
+        not yet handed out as results, which keeps the memory use flat no
+        matter how many messages there are.
+
+        Failed messages do not stop the others, their results carry the
+        error, messages that can not be made or are invalid included.  With
+        a :class:`RetryPolicy`, transient failures are retried as
+        :meth:`send` does.  Stopping the iteration early stops taking new
+        messages, the ones being sent are finished.
+
+        :param messages: an iterable of message instances, or of functions
+                         without arguments returning one, which are called
+                         only when there is room in the window
+        :param concurrency: see :meth:`send`, default to be one connection
+        :param window: the most messages in memory at once, default to be
+                       100
+        :param render_processes: see :meth:`send`
+        """
+        if self.direct:
+            raise SenderError('direct delivery does not support streaming')
+        if render_processes:
+            if ProcessPoolExecutor is None:
+                raise SenderError('render_processes needs the '
+                                  'concurrent.futures module')
+            messages = self._render_ahead(messages, render_processes)
+        done = Queue()
+        delivery = _Delivery(self, messages, concurrency or 1,
+                            self.retry or RetryPolicy(max_attempts=1),
+                            lambda index, result: done.put(result),
+                            window, stopped=lambda: done.put(None))
+        delivery.start()
+        try:
+            while True:
+                result = done.get()
+                if result is None:
+                    break
+                yield result
+                delivery.release()
+        finally:
+            delivery.close()
+        if delivery.errors:
+            raise delivery.errors[0]
+
+    def prepare(self, message):
+        """Fill in the defaults of this mail instance and validate one
+        message before it is sent.
+
+        :param message: one message instance
+        """
+        if self.fromaddr and not message.fromaddr:
+            message.fromaddr = self.fromaddr
+        if isinstance(message, Message):
+            if message._message_id is None:
+                message._message_id = self.make_message_id()
+            message._renderer = self.renderer
+        message.validate()
 
     def send_message(self, *args, **kwargs):
         """Shortcut for send.
         """
-        self.send(Message(*args, **kwargs))
+        return self.send(Message(*args, **kwargs))
+
+    def send_merge(self, template, rows, concurrency=None,
+                   render_processes=None):
+        """Mail merge, sends one message made from one template for each
+        row.  Returns the results just like :meth:`send` does for multiple
+        messages.
+
+        :param template: one :class:`MessageTemplate` instance
+        :param rows: an iterable of dictionaries, see
+                     :meth:`MessageTemplate.render`
+        :param concurrency: see :meth:`send`
+        :param render_processes: see :meth:`send`
+        """
+        return self.send((template.render(row) for row in rows),
+                         concurrency, render_processes)
+
+
+class _Delivery(object):
+    """The worker threads behind :meth:`Mail.send` with a retry policy and
+    :meth:`Mail.stream`.  They share one connection each and one queue of
+    messages, put transient failures back in it until they are due again,
+    and report every message once it is done.
+
+    :param mail: one mail instance
+    :param messages: an iterable of message instances, or of functions
+                     returning one
+    :param concurrency: the number of worker threads and connections
+    :param policy: one :class:`RetryPolicy` instance
+    :param finished: called with the index of one message in ``messages``
+                     and its :class:`SendResult` once it is done
+    :param window: the most messages taken from ``messages`` and not yet
+                   given back by :meth:`release`, default to be None (no
+                   limit)
+    :param stopped: called once the last worker is gone
+    """
+
+    def __init__(self, mail, messages, concurrency, policy, finished,
+                 window=None, stopped=None):
+        self.mail = mail
+        self.messages = enumerate(messages)
+        if mail.max_connections is not None:
+            concurrency = min(concurrency, mail.max_connections)
+        self.concurrency = concurrency
+        self.policy = policy
+        self.finished = finished
+        self.window = window
+        self.stopped = stopped
+        self.cond = threading.Condition()
+        # results of the messages being sent or waiting to be retried
+        self.results = {}
+        # (due time, index, envelope) of the messages waiting to be retried
+        self.waiting = []
+        self.in_flight = 0
+        self.taken = 0
+        self.exhausted = False
+        self.closed = False
+        self.errors = []
+        self.workers = []
+        self.alive = concurrency
+
+    def run(self):
+        """Send all the messages, the calling thread is one of the workers.
+        The first unexpected error is raised once all of them are done.
+        """
+        self.start(self.concurrency - 1)
+        self.work()
+        for worker in self.workers:
+            worker.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def start(self, workers=None):
+        """Start the workers in the background.
+        """
+        if workers is None:
+            workers = self.concurrency
+        for i in range(workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def release(self):
+        """Give back the place of one finished message in the window.
+        """
+        with self.cond:
+            self.taken -= 1
+            self.cond.notify_all()
+
+    def close(self):
+        """Take no more messages, the ones being sent are finished.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def next_item(self):
+        with self.cond:
+            while not (self.errors or self.closed):
+                if self.waiting and self.waiting[0][0] <= time.time():
+                    self.in_flight += 1
+                    return heapq.heappop(self.waiting)[1:]
+                full = self.window is not None and self.taken >= self.window
+                if not self.exhausted and not full:
+                    try:
+                        index, message = next(self.messages)
+                    except StopIteration:
+                        self.exhausted = True
+                        continue
+                    self.results[index] = SendResult(message)
+                    self.in_flight += 1
+                    self.taken += 1
+                    return index, None
+                if self.waiting:
+                    self.cond.wait(self.waiting[0][0] - time.time())
+                elif self.in_flight or (full and not self.exhausted):
+                    self.cond.wait()
+                else:
+                    return None
+
+    def finish(self, index, to_addrs, sent, refused, error, elapsed):
+        policy = self.policy
+        with self.cond:
+            result = self.results[index]
+            self.in_flight -= 1
+            result.attempts += 1
+            result.elapsed += elapsed
+            if sent is not None:
+                result.accepted.extend(sent.accepted)
+                result.reply = sent.reply
+                result.bytes_sent += sent.bytes_sent
+            again = result.attempts < policy.max_attempts
+            for address in to_addrs:
+                result.refused.pop(address, None)
+            result.refused.update(refused)
+            if isinstance(error, smtplib.SMTPRecipientsRefused):
+                # decided recipient by recipient below
+                error = None
+            deferred = [address for address, (code, resp)
+                        in iteritems(refused)
+                        if policy.is_transient_reply(code)]
+            if error is not None and again and policy.is_transient(error):
+                deferred = to_addrs
+            elif error is None and deferred and again:
+                error = smtplib.SMTPRecipientsRefused(
+                    dict((a, refused[a]) for a in deferred))
+            else:
+                deferred = []
+            if deferred:
+                due = time.time() + policy.delay(result.attempts)
+                envelope = Envelope(result.message, deferred)
+                heapq.heappush(self.waiting, (due, index, envelope))
+            else:
+                if error is None and \
+                        len(result.refused) == len(result.message.to_addrs):
+                    error = smtplib.SMTPRecipientsRefused(
+                        dict(result.refused))
+                del self.results[index]
+            result.error = error
+            self.cond.notify_all()
+        if not deferred:
+            self.finished(index, result)
+
+    def prepare(self, index):
+        # one message taken from the iterable, functions are called to make
+        # it.  Invalid messages are done at once, with the error
+        result = self.results[index]
+        try:
+            if callable(result.message):
+                result.message = result.message()
+            self.mail.prepare(result.message)
+        except SenderError as e:
+            self.finish(index, [], None, {}, e, 0.0)
+            return None
+        return result.message
+
+    def work(self):
+        connection = None
+        try:
+            while True:
+                item = self.next_item()
+                if item is None:
+                    break
+                index, envelope = item
+                if envelope is None:
+                    envelope = self.prepare(index)
+                    if envelope is None:
+                        continue
+                sent, refused, error = None, {}, None
+                start = time.time()
+                try:
+                    if connection is None:
+                        connection = self.mail.connection.__enter__()
+                    sent = connection.send(envelope)
+                    refused = sent.refused
+                except smtplib.SMTPRecipientsRefused as e:
+                    refused, error = e.recipients, e
+                except (smtplib.SMTPException, socket.error) as e:
+                    error = e
+                    if connection is not None and is_broken(e):
+                        # open one new connection for the next message
+                        connection.__exit__(type(e), e, None)
+                        connection = None
+                self.finish(index, envelope.to_addrs, sent, refused, error,
+                            time.time() - start)
+        except Exception as e:
+            with self.cond:
+                self.errors.append(e)
+                self.cond.notify_all()
+        finally:
+            if connection is not None:
+                connection.__exit__(None, None, None)
+            with self.cond:
+                self.alive -= 1
+                last = self.alive == 0
+            if last and self.stopped is not None:
+                self.stopped()
+
+
+def _submit_render(executor, message):
+    if not isinstance(message, Message) or message.has_streams:
+        return None
+    # fixes the date, the worker must render the same message
+    message._cache()
+    try:
+        state = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+    return executor.submit(_render_pickled, state)
+
+
+def _render_pickled(state):
+    return pickle.loads(state).as_bytes()
+
+
+def _rendered(message, future):
+    if future is not None:
+        try:
+            data = future.result()
+        except Exception:
+            # rendered again while it is sent, where the error belongs
+            return message
+        message._cache()['bytes'] = data
+    return message
 
 
 class Connection(object):
@@ -107,45 +819,1097 @@ class Connection(object):
     class would be one context manager so that you do not have to manage
     connection close manually.
 
-    TODO: connection pool?
-
     :param mail: one mail instance
+    :param hosts: the :class:`HostList` to connect to, default to be the
+                  hosts of the mail instance
+    :param metrics: one :class:`Metrics` instance, default to be the one of
+                    the mail instance
     """
 
-    def __init__(self, mail):
+    def __init__(self, mail, hosts=None, metrics=None):
         self.mail = mail
+        self.hosts = hosts if hosts is not None else mail.hosts
+        self.metrics = metrics if metrics is not None else mail.metrics
 
     def __enter__(self):
+        limiter = self.mail.rate_limiter
+        if limiter is not None:
+            limiter.open_connection()
+        try:
+            if self.mail.pool is not None:
+                self.server = self.mail.pool.get()
+            else:
+                self.server = self.connect()
+        except Exception as e:
+            if limiter is not None:
+                limiter.feedback(reply_codes(e))
+                limiter.close_connection()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        try:
+            if self.mail.pool is not None:
+                self.mail.pool.put(self.server, dirty=exc_type is not None)
+            else:
+                try:
+                    self.server.quit()
+                except (smtplib.SMTPException, socket.error):
+                    # the session is gone already, do not hide the real error
+                    self.server.close()
+        finally:
+            if self.mail.rate_limiter is not None:
+                self.mail.rate_limiter.close_connection()
+
+    def connect(self):
+        """Open one new SMTP session, put it in TLS mode and log in if
+        needed.  The hosts are tried in the order of
+        :meth:`HostList.candidates`, and the ones that cannot be reached are
+        left out for a while.
+        """
+        hosts = self.hosts
+        error = None
+        for endpoint in hosts.candidates():
+            try:
+                server = self._connect(endpoint)
+            except (smtplib.SMTPConnectError,
+                    smtplib.SMTPServerDisconnected) as e:
+                error = e
+            except smtplib.SMTPException:
+                self.metrics.increment('connections.failed', 1, endpoint.host)
+                raise
+            except socket.error as e:
+                error = e
+            else:
+                hosts.mark_up(endpoint)
+                server.endpoint = endpoint
+                self.metrics.increment('connections.opened', 1, endpoint.host)
+                return server
+            hosts.mark_down(endpoint)
+            self.metrics.increment('connections.failed', 1, endpoint.host)
+        if error is None:
+            raise SenderError('no SMTP server to connect to')
+        raise error
+
+    def _connect(self, endpoint):
+        metrics = self.metrics
+        start = time.time()
         if self.mail.use_ssl:
-            server = smtplib.SMTP_SSL(self.mail.host, self.mail.port)
+            server = smtplib.SMTP_SSL(endpoint.host, endpoint.port)
         else:
-            server = smtplib.SMTP(self.mail.host, self.mail.port)
+            server = smtplib.SMTP(endpoint.host, endpoint.port)
+        metrics.timing('connect', time.time() - start, endpoint.host)
 
         # Set the debug output level
         if self.mail.debug_level is not None:
             server.set_debuglevel(int(self.mail.debug_level))
 
         if self.mail.use_tls:
+            start = time.time()
             server.starttls()
+            metrics.timing('tls', time.time() - start, endpoint.host)
 
         if self.mail.username and self.mail.password:
+            start = time.time()
             server.login(self.mail.username, self.mail.password)
+            metrics.timing('auth', time.time() - start, endpoint.host)
 
-        self.server = server
-
-        return self
-
-    def __exit__(self, exc_type, exc_value, exc_tb):
-        self.server.quit()
+        return server
 
     def send(self, message):
-        """Send one message instance.
+        """Send one message instance, returns one :class:`SendResult` with
+        the accepted and refused recipients, the server reply, the time
+        spent and the bytes sent.
 
         :param message: one message instance.
         """
-        self.server.sendmail(message.fromaddr, message.to_addrs,
-                             str(message) if PY2 else message.as_bytes(),
-                             message.mail_options, message.rcpt_options)
+        limiter = self.mail.rate_limiter
+        if limiter is not None:
+            limiter.wait(len(message.to_addrs))
+        result = SendResult(message)
+        result.attempts = 1
+        start = time.time()
+        envelopes = split_recipients(message, self.mail.max_recipients)
+        try:
+            if len(envelopes) == 1:
+                self._send_failover(result)
+            else:
+                # one transaction per chunk, all of them reuse the rendered
+                # message of the first one.  One failed chunk must not hide
+                # the chunks delivered already, its recipients are refused
+                # with the error, so that only they are sent again
+                for envelope in envelopes:
+                    sent = SendResult(envelope)
+                    try:
+                        self._send_failover(sent)
+                    except smtplib.SMTPRecipientsRefused as e:
+                        sent.refused = e.recipients
+                    except (smtplib.SMTPException, socket.error) as e:
+                        sent.refused = refused_by(e, envelope.to_addrs)
+                    result.merge(sent)
+                if not result.accepted:
+                    raise smtplib.SMTPRecipientsRefused(result.refused)
+        except smtplib.SMTPException as e:
+            if limiter is not None:
+                limiter.feedback(reply_codes(e))
+            self.metrics.increment('messages.failed', 1,
+                                   self.server.endpoint.host)
+            raise
+        finally:
+            result.elapsed = time.time() - start
+        if limiter is not None:
+            limiter.feedback(result.codes)
+        self.metrics.record(result, self.server.endpoint.host)
+        return result
+
+    def _send_failover(self, result):
+        # when the session breaks, send again through the other hosts
+        tries = len(self.hosts)
+        while True:
+            try:
+                return self._send(result)
+            except (smtplib.SMTPException, socket.error) as e:
+                tries -= 1
+                if tries <= 0 or not is_broken(e):
+                    raise
+                self.hosts.mark_down(self.server.endpoint)
+                self.server.close()
+                self.server = self.connect()
+
+    def _send(self, result):
+        message = result.message
+        metrics = self.metrics
+        host = self.server.endpoint.host
+        self.server.ehlo_or_helo_if_needed()
+        if message.has_streams:
+            # rendered bit by bit while it is written
+            chunks, size = message.iter_bytes(), None
+        else:
+            start = time.time()
+            msg = str(message) if PY2 else message.as_bytes()
+            metrics.timing('render', time.time() - start, host)
+            chunks, size = [msg], len(msg)
+        start = time.time()
+        try:
+            self._send_chunks(result, chunks, size)
+        finally:
+            metrics.timing('transmit', time.time() - start, host)
+            metrics.increment('bytes', result.bytes_sent, host)
+
+    def _send_chunks(self, result, chunks, size=None):
+        server = self.server
+        message = result.message
+        mail_options = list(message.mail_options)
+        if size is not None and server.has_extn('size'):
+            mail_options.insert(0, 'size=%d' % size)
+        to_addrs = list(message.to_addrs)
+        commands = envelope_commands(message.fromaddr, to_addrs,
+                                     mail_options, message.rcpt_options)
+        if server.has_extn('pipelining'):
+            # ESMTP PIPELINING (RFC 2920): MAIL, all RCPTs and DATA go out
+            # in one write, and the replies are read afterwards
+            server.send(''.join(c + '\r\n' for c in commands))
+            replies = [server.getreply() for c in commands]
+        else:
+            replies = self._send_envelope(commands)
+        refused, error = check_envelope(message.fromaddr, to_addrs, replies)
+        result.refused = refused
+        if error is None:
+            for chunk in quote_chunks(chunks):
+                server.send(chunk)
+                result.bytes_sent += len(chunk)
+            result.reply = server.getreply()
+            if result.reply[0] != 250:
+                error = smtplib.SMTPDataError(*result.reply)
+        elif replies[-1][0] == 354:
+            # the server wants data we are not going to send
+            server.send(b'.\r\n')
+            server.getreply()
+        if error is not None:
+            if getattr(error, 'smtp_code', None) == 421:
+                server.close()
+            else:
+                try:
+                    server.rset()
+                except smtplib.SMTPServerDisconnected:
+                    pass
+            raise error
+        result.accepted = [addr for addr in to_addrs if addr not in refused]
+
+    def _send_envelope(self, commands):
+        # one command after the other, stop as soon as the transaction fails
+        replies = []
+        for command in commands:
+            if command == 'data' and \
+                    not any(code in (250, 251) for code, _ in replies[1:]):
+                break
+            self.server.putcmd(command)
+            replies.append(self.server.getreply())
+            if replies[0][0] != 250:
+                break
+        return replies + [(-1, b'')] * (len(commands) - len(replies))
+
+
+class Metrics(object):
+    """Receives the measurements of the sends.  This base class ignores
+    them, subclass it to feed your monitoring system, see
+    :class:`StatsdMetrics`.
+
+    The phases timed are ``connect``, ``tls``, ``auth``, ``render`` and
+    ``transmit``.  The counters are ``connections.opened``,
+    ``connections.failed``, ``messages.sent``, ``messages.failed``,
+    ``recipients.accepted``, ``recipients.refused`` and ``bytes``.
+    """
+
+    def timing(self, phase, seconds, host=None):
+        """Called with the duration of one phase on one SMTP server.
+        """
+
+    def increment(self, name, value=1, host=None):
+        """Called to add to one counter.
+        """
+
+    def record(self, result, host=None):
+        """Called with the :class:`SendResult` of every sent message.
+        """
+        self.increment('messages.sent', 1, host)
+        self.increment('recipients.accepted', len(result.accepted), host)
+        if result.refused:
+            self.increment('recipients.refused', len(result.refused), host)
+
+
+null_metrics = Metrics()
+
+
+class StatsdMetrics(Metrics):
+    """Sends the measurements to one StatsD server over UDP, timings in
+    milliseconds.  Errors are ignored, so that monitoring never gets in the
+    way of sending mail.
+
+    :param host: the StatsD server host
+    :param port: the StatsD server port
+    :param prefix: prefix of all metric names
+    :param per_host: put the SMTP server in the metric names too, like
+                     ``sender.smtp_example_com.connect``
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='sender',
+                 per_host=False):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.per_host = per_host
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def name(self, name, host=None):
+        if self.per_host and host:
+            name = re.sub(r'[^\w-]', '_', host) + '.' + name
+        return '%s.%s' % (self.prefix, name) if self.prefix else name
+
+    def timing(self, phase, seconds, host=None):
+        self.send('%s:%.3f|ms' % (self.name(phase, host), seconds * 1000))
+
+    def increment(self, name, value=1, host=None):
+        self.send('%s:%d|c' % (self.name(name, host), value))
+
+    def send(self, line):
+        try:
+            self.sock.sendto(line.encode('utf-8'), self.address)
+        except socket.error:
+            pass
+
+
+class Endpoint(object):
+    """One SMTP server of one :class:`HostList`.
+    """
+
+    def __init__(self, host, port=25, weight=1, priority=0):
+        self.host = host
+        self.port = port
+        self.weight = weight
+        #: servers with lower priority are tried first, like MX preferences
+        self.priority = priority
+        #: the host is left out until this time
+        self.down_until = 0
+        #: consecutive failures
+        self.failures = 0
+
+    def __repr__(self):
+        return '<Endpoint %s:%d>' % (self.host, self.port)
+
+
+class HostList(object):
+    """The SMTP servers of one mail instance.  New connections are spread
+    over the healthy servers at random, in proportion to their weights, and
+    one server that fails is left out for ``cooldown`` seconds.
+
+    :param hosts: one host, or a list of hosts, ``(host, port)`` or
+                  ``(host, port, weight)`` tuples
+    :param port: the port of the hosts given without one
+    :param cooldown: seconds one failing server is left out
+    :param resolve_mx: the hosts are mail domains, use the servers of their
+                       MX records instead, ordered by preference
+    :param resolver: one function returning ``(preference, host)`` pairs
+                     for one domain, default to be :func:`lookup_mx`
+    :param mx_ttl: seconds before the MX records are looked up again
+    """
+
+    def __init__(self, hosts, port=25, cooldown=30.0, resolve_mx=False,
+                 resolver=None, mx_ttl=300.0):
+        if isinstance(hosts, string_types) or \
+                isinstance(hosts, tuple) and len(hosts) <= 3 and \
+                isinstance(hosts[-1], int):
+            hosts = [hosts]
+        self.port = port
+        self.cooldown = cooldown
+        self.resolver = resolver or lookup_mx
+        self.mx_ttl = mx_ttl
+        self._lock = threading.Lock()
+        if resolve_mx:
+            self.domains = list(hosts)
+            self._endpoints = None
+            self._resolved = 0
+        else:
+            self.domains = None
+            self._endpoints = [self._endpoint(h) for h in hosts]
+
+    def _endpoint(self, host):
+        if isinstance(host, string_types):
+            return Endpoint(host, self.port)
+        return Endpoint(*host)
+
+    @property
+    def endpoints(self):
+        """All servers, looking the MX records up if needed.
+        """
+        if self.domains is not None and \
+                time.time() - self._resolved > self.mx_ttl:
+            endpoints = []
+            for domain in self.domains:
+                for preference, host in self.resolver(domain):
+                    endpoints.append(Endpoint(host, self.port,
+                                              priority=preference))
+            with self._lock:
+                # keep what we know about the servers already seen
+                known = dict(((e.host, e.port), e)
+                             for e in self._endpoints or [])
+                for i, e in enumerate(endpoints):
+                    old = known.get((e.host, e.port))
+                    if old is not None:
+                        old.priority = e.priority
+                        endpoints[i] = old
+                self._endpoints = endpoints
+                self._resolved = time.time()
+        return self._endpoints
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def candidates(self):
+        """Returns the servers in the order they should be tried: the
+        healthy ones by priority, shuffled by weight within one priority,
+        then the failing ones, the one back soonest first.
+        """
+        endpoints = self.endpoints
+        now = time.time()
+        with self._lock:
+            healthy = [e for e in endpoints if e.down_until <= now]
+            down = sorted((e for e in endpoints if e.down_until > now),
+                          key=lambda e: e.down_until)
+        ordered = []
+        for priority in sorted(set(e.priority for e in healthy)):
+            group = [e for e in healthy if e.priority == priority]
+            while group:
+                pick = random.uniform(0, sum(e.weight for e in group))
+                for e in group:
+                    pick -= e.weight
+                    if pick <= 0:
+                        break
+                group.remove(e)
+                ordered.append(e)
+        return ordered + down
+
+    def mark_down(self, endpoint):
+        """Leave one failing server out for ``cooldown`` seconds.
+        """
+        with self._lock:
+            endpoint.failures += 1
+            endpoint.down_until = time.time() + self.cooldown
+
+    def mark_up(self, endpoint):
+        """Record one successful connection to one server.
+        """
+        with self._lock:
+            endpoint.failures = 0
+            endpoint.down_until = 0
+
+
+def lookup_mx(domain):
+    """Returns the ``(preference, host)`` pairs of the MX records of one
+    domain, sorted by preference, or the domain itself if it has none.
+    Raises :class:`SenderError` if the domain does not exist or can not be
+    resolved.  This needs the ``dnspython`` package.
+    """
+    try:
+        import dns.exception
+        import dns.resolver
+    except ImportError:
+        raise SenderError('resolving MX records needs dnspython')
+    resolve = getattr(dns.resolver, 'resolve', None) or dns.resolver.query
+    try:
+        answer = resolve(domain, 'MX')
+    except dns.resolver.NoAnswer:
+        return [(0, domain)]
+    except dns.resolver.NXDOMAIN:
+        raise SenderError('domain %s does not exist' % domain)
+    except (dns.resolver.NoNameservers, dns.exception.Timeout) as e:
+        raise SenderError('can not resolve %s: %s' % (domain, e))
+    return sorted((record.preference, record.exchange.to_text().rstrip('.'))
+                  for record in answer)
+
+
+class ConnectionPool(object):
+    """A bounded, thread-safe pool of logged-in SMTP sessions.  Sessions are
+    checked with ``NOOP`` before they are handed out, and dead ones are
+    replaced transparently.
+
+    :param mail: one mail instance, used to open new sessions
+    :param max_size: maximum number of sessions open at the same time
+    :param idle_timeout: seconds one session may stay idle before it is
+                         closed, None means forever
+    :param timeout: seconds to wait for a free session when all of them are
+                    in use, None means forever
+    """
+
+    def __init__(self, mail, max_size=10, idle_timeout=None, timeout=None):
+        self.mail = mail
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        # idle sessions as (server, released at) pairs, most recent last
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+
+    @property
+    def size(self):
+        """Number of sessions currently open, idle or in use."""
+        return self._size
+
+    @property
+    def idle(self):
+        """Number of sessions waiting in the pool."""
+        return len(self._idle)
+
+    def get(self):
+        """Check out one healthy session, opening a new one if needed.
+        """
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        server = None
+        with self._cond:
+            expired = self._pop_expired()
+            while True:
+                if self._idle:
+                    server = self._idle.pop()[0]
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                if self.timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise SenderError('connection pool exhausted')
+                    self._cond.wait(remaining)
+        for s in expired:
+            self._quit(s)
+
+        if server is not None:
+            if self._is_alive(server):
+                return server
+            self._quit(server)
+        try:
+            return Connection(self.mail).connect()
+        except Exception:
+            self._release_slot()
+            raise
+
+    def put(self, server, dirty=False):
+        """Return one session to the pool.  A dirty session, that is one
+        used when some error happened, is reset with ``RSET`` first and
+        dropped if that fails.
+
+        :param server: one session got from :meth:`get`
+        :param dirty: whether the session may be left in a bad state
+        """
+        if dirty:
+            try:
+                if server.rset()[0] != 250:
+                    raise smtplib.SMTPException()
+            except (smtplib.SMTPException, socket.error):
+                self._quit(server)
+                self._release_slot()
+                return
+        with self._cond:
+            self._idle.append((server, time.time()))
+            self._cond.notify()
+
+    def close(self):
+        """Close all idle sessions.
+        """
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for server, _ in idle:
+            self._quit(server)
+
+    def _pop_expired(self):
+        if self.idle_timeout is None:
+            return []
+        now = time.time()
+        expired = [s for s, t in self._idle if now - t > self.idle_timeout]
+        if expired:
+            self._idle = [(s, t) for s, t in self._idle
+                          if now - t <= self.idle_timeout]
+            self._size -= len(expired)
+        return expired
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _is_alive(self, server):
+        try:
+            return server.noop()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def _quit(self, server):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, socket.error):
+            server.close()
+
+
+class Spool(object):
+    """A durable outbound queue kept in one SQLite file.  Messages are
+    stored already rendered, and background worker threads send them in
+    batches over one connection each.  Several processes may share one
+    file, every batch is leased to the spool instance that took it, and
+    messages that were being sent by one process that died are queued again
+    once their lease runs out.  Transient
+    failures are tried again later as the retry policy says, the others
+    are kept as failed.
+
+    :param mail: one mail instance, used to send the messages
+    :param path: path of the SQLite file
+    :param workers: number of delivery threads, 0 means no thread, call
+                    :meth:`process` to deliver
+    :param batch_size: the most messages sent over one connection
+    :param poll_interval: seconds idle workers sleep before looking for
+                          messages stored by other processes
+    :param retry: one :class:`RetryPolicy` instance, default to be the one
+                  of the mail instance, or the default policy
+    :param lease: seconds one batch stays reserved without any progress,
+                  default to be 300
+    """
+
+    PENDING, SENDING, FAILED = 0, 1, 2
+
+    #: columns added after the first version, with their definitions
+    _added_columns = [
+        ('attempts', 'INTEGER NOT NULL DEFAULT 0'),
+        ('next_attempt', 'REAL NOT NULL DEFAULT 0'),
+        ('owner', 'TEXT'),
+        ('claimed', 'REAL'),
+    ]
+
+    def __init__(self, mail, path, workers=1, batch_size=100,
+                 poll_interval=1.0, retry=None, lease=300.0):
+        self.mail = mail
+        self.path = path
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retry = retry or mail.retry or RetryPolicy()
+        self.lease = lease
+        # tells the batches of this instance from the ones of the others
+        self._owner = uuid.uuid4().hex
+        #: counters of the messages sent and failed by this instance
+        self.sent = 0
+        self.failed = 0
+        #: the last error that stopped one batch, like a connection that
+        #: could not be opened, None if there was none
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._closed = False
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS spool ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, state INTEGER NOT NULL, '
+            'fromaddr TEXT, to_addrs TEXT, mail_options TEXT, '
+            'rcpt_options TEXT, data BLOB, error TEXT, created REAL)')
+        columns = set(row[1] for row in
+                      self._db.execute('PRAGMA table_info(spool)'))
+        for name, definition in self._added_columns:
+            if name not in columns:
+                self._db.execute('ALTER TABLE spool ADD COLUMN %s %s'
+                                 % (name, definition))
+        self._db.commit()
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def put(self, message):
+        """Stores one message, returns its id.
+        """
+        data = str(message) if PY2 else message.as_bytes()
+        with self._lock:
+            cursor = self._db.execute(
+                'INSERT INTO spool (state, fromaddr, to_addrs, mail_options, '
+                'rcpt_options, data, created) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (self.PENDING, message.fromaddr,
+                 json.dumps(sorted(message.to_addrs)),
+                 json.dumps(list(message.mail_options)),
+                 json.dumps(list(message.rcpt_options)),
+                 sqlite3.Binary(data), time.time()))
+            self._db.commit()
+            self._wakeup.notify()
+        return cursor.lastrowid
+
+    def depth(self):
+        """Returns the number of pending, sending and failed messages.
+        """
+        counts = {'pending': 0, 'sending': 0, 'failed': 0}
+        names = {self.PENDING: 'pending', self.SENDING: 'sending',
+                 self.FAILED: 'failed'}
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT state, COUNT(*) FROM spool GROUP BY state').fetchall()
+        for state, count in rows:
+            counts[names[state]] = count
+        return counts
+
+    def failures(self):
+        """Returns (id, RawMessage, error) for each failed message.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT id, fromaddr, to_addrs, mail_options, rcpt_options, '
+                'data, error FROM spool WHERE state = ? ORDER BY id',
+                (self.FAILED,)).fetchall()
+        return [(row[0], self._load(row[1:6]), row[6]) for row in rows]
+
+    def process(self):
+        """Delivers one batch of pending messages in the calling thread,
+        returns the number of messages taken.
+        """
+        batch = self._claim()
+        if batch:
+            self._deliver(batch)
+        return len(batch)
+
+    def close(self):
+        """Stops the workers once they are done with their current batch.
+        """
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify_all()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self._db.close()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+            batch = self._claim()
+            if not batch or not self._deliver(batch):
+                with self._lock:
+                    if not self._closed:
+                        self._wakeup.wait(self.poll_interval)
+
+    def _claim(self):
+        with self._lock:
+            if self._closed:
+                return []
+            now = time.time()
+            # recover the messages in flight when their process died
+            self._db.execute(
+                'UPDATE spool SET state = ?, owner = NULL WHERE state = ? '
+                'AND (claimed IS NULL OR claimed < ?)',
+                (self.PENDING, self.SENDING, now - self.lease))
+            rows = self._db.execute(
+                'SELECT id, fromaddr, to_addrs, mail_options, rcpt_options, '
+                'data, attempts FROM spool WHERE state = ? AND '
+                'next_attempt <= ? ORDER BY id LIMIT ?',
+                (self.PENDING, now, self.batch_size)).fetchall()
+            self._db.executemany(
+                'UPDATE spool SET state = ?, owner = ?, claimed = ? '
+                'WHERE id = ?',
+                [(self.SENDING, self._owner, now, row[0]) for row in rows])
+            self._db.commit()
+        return [(row[0], self._load(row[1:6]), row[6]) for row in rows]
+
+    def _load(self, row):
+        fromaddr, to_addrs, mail_options, rcpt_options, data = row
+        return RawMessage(fromaddr, json.loads(to_addrs), bytes(data),
+                          json.loads(mail_options), json.loads(rcpt_options))
+
+    def _deliver(self, batch):
+        # returns False if the connection failed
+        done = []
+        current = None
+        renewed = time.time()
+        try:
+            with self.mail.connection as c:
+                for id, message, attempts in batch:
+                    if time.time() - renewed > self.lease / 3.0:
+                        renewed = self._renew()
+                    current = id, attempts
+                    try:
+                        c.send(message)
+                    except smtplib.SMTPServerDisconnected:
+                        raise
+                    except smtplib.SMTPException as e:
+                        self._finish(id, e, attempts + 1)
+                    else:
+                        self._finish(id)
+                    done.append(id)
+                    current = None
+        except Exception as e:
+            # the connection is gone or could not be opened.  The message
+            # being sent counts one attempt, so that one message breaking
+            # the connection every time is not tried forever, and the rest
+            # is tried again later
+            self.last_error = e
+            if current is not None:
+                self._finish(current[0], e, current[1] + 1)
+                done.append(current[0])
+            with self._lock:
+                self._db.executemany(
+                    'UPDATE spool SET state = ? WHERE id = ?',
+                    [(self.PENDING, id) for id, _, _ in batch
+                     if id not in done])
+                self._db.commit()
+            return False
+        return True
+
+    def _renew(self):
+        # keeps the rest of one slow batch from being taken by the others
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'UPDATE spool SET claimed = ? WHERE state = ? AND owner = ?',
+                (now, self.SENDING, self._owner))
+            self._db.commit()
+        return now
+
+    def _finish(self, id, error=None, attempts=1):
+        policy = self.retry
+        with self._lock:
+            if error is None:
+                self._db.execute('DELETE FROM spool WHERE id = ?', (id,))
+                self.sent += 1
+            elif attempts < policy.max_attempts and \
+                    policy.is_transient(error):
+                self._db.execute(
+                    'UPDATE spool SET state = ?, error = ?, attempts = ?, '
+                    'next_attempt = ? WHERE id = ?',
+                    (self.PENDING, repr(error), attempts,
+                     time.time() + policy.delay(attempts), id))
+            else:
+                self._db.execute(
+                    'UPDATE spool SET state = ?, error = ? WHERE id = ?',
+                    (self.FAILED, repr(error), id))
+                self.failed += 1
+            self._db.commit()
+
+
+class RetryPolicy(object):
+    """Tells transient delivery failures from permanent ones, and spaces
+    the tries of one message with jittered exponential backoff.  Broken
+    connections and 4xx replies are transient, 5xx replies are permanent.
+
+    :param max_attempts: the most times one message is tried
+    :param base_delay: seconds to wait before the first retry, the wait is
+                       doubled for every next one
+    :param max_delay: the longest wait between two tries
+    :param jitter: fraction of every wait that is random, so that the
+                   retries of many messages do not come back all at once
+    """
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=300.0,
+                 jitter=0.5):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempts):
+        """Seconds to wait after the given number of failed tries.
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay - delay * self.jitter * random.random()
+
+    def is_transient_reply(self, code):
+        """Whether one SMTP reply code may turn into success later.
+        """
+        return 400 <= code < 500
+
+    def is_transient(self, error):
+        """Whether one failed try is worth repeating.
+        """
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all(self.is_transient_reply(code)
+                       for code, resp in itervalues(error.recipients))
+        if isinstance(error, smtplib.SMTPResponseException):
+            # smtplib uses -1 when the connection could not be opened
+            return error.smtp_code == -1 or \
+                self.is_transient_reply(error.smtp_code)
+        if isinstance(error, smtplib.SMTPServerDisconnected):
+            return True
+        # SMTPException is one socket.error subclass on Python 3
+        return not isinstance(error, smtplib.SMTPException) and \
+            isinstance(error, socket.error)
+
+
+class SendResult(object):
+    """The outcome of sending one message, see :meth:`Mail.send`.
+
+    :param message: the message
+    """
+
+    def __init__(self, message):
+        self.message = message
+        #: recipients accepted by the server
+        self.accepted = []
+        #: refused recipients, {address: (code, response)}
+        self.refused = {}
+        #: the server reply to the message data, (code, response)
+        self.reply = None
+        #: the error of the last try, None if the message was sent
+        self.error = None
+        #: number of tries
+        self.attempts = 0
+        #: seconds spent sending, over all tries
+        self.elapsed = 0.0
+        #: bytes of message data written, over all tries
+        self.bytes_sent = 0
+
+    @property
+    def ok(self):
+        """Whether the message was accepted for at least one recipient.
+        """
+        return self.error is None
+
+    def merge(self, other):
+        """Add the outcome of one more transaction of the same message.
+        """
+        self.accepted.extend(other.accepted)
+        self.refused.update(other.refused)
+        if other.reply is not None:
+            self.reply = other.reply
+        self.elapsed += other.elapsed
+        self.bytes_sent += other.bytes_sent
+        self.attempts = max(self.attempts, other.attempts)
+
+    @property
+    def codes(self):
+        """All SMTP reply codes of the recipients and the message data.
+        """
+        codes = [code for code, resp in itervalues(self.refused)]
+        if self.reply is not None:
+            codes.append(self.reply[0])
+        return codes
+
+    def __repr__(self):
+        return '<SendResult accepted=%r refused=%r error=%r>' % (
+            self.accepted, self.refused, self.error)
+
+
+def reply_codes(error):
+    """Returns the SMTP reply codes carried by one error.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return [code for code, resp in itervalues(error.recipients)]
+    if isinstance(error, smtplib.SMTPResponseException):
+        return [error.smtp_code]
+    return []
+
+
+def refused_by(error, to_addrs):
+    """Returns the refused recipients dictionary of one transaction that
+    failed as a whole, every recipient gets the reply of the error, or -1
+    if it has none.
+    """
+    code = getattr(error, 'smtp_code', -1)
+    resp = getattr(error, 'smtp_error', str(error).encode('utf-8'))
+    return dict((addr, (code, resp)) for addr in to_addrs)
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket.  Tokens are handed out ahead of time, so
+    callers are spaced out fairly: each one is told how long to wait until
+    its own tokens exist.
+
+    :param rate: tokens added per second
+    :param burst: the most tokens the bucket holds, default to be one
+                  second worth of tokens
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1.0, self.rate)
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Take tokens, returns the seconds to wait before using them.
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class RateLimiter(object):
+    """Paces the sends of one or more mail instances.  Rates are cut down
+    every time the server answers 421 or 451, and grow back to the
+    configured ones step by step while sends succeed.
+
+    For asyncio, :meth:`reserve` and :meth:`try_open_connection` never
+    block, see :class:`sender_async.AsyncMail`.
+
+    :param messages_per_second: the most messages sent per second
+    :param recipients_per_second: the most recipients sent per second
+    :param max_connections: the most connections in use at the same time
+    :param burst: how many messages (recipients) may be sent at once after
+                  one idle time, default to be one second worth
+    :param backoff: the rates are multiplied by this on 421 and 451
+    :param recovery: the fraction of the configured rates added back after
+                     every successful send
+    :param min_rate: the rates never drop below this fraction of the
+                     configured ones
+    """
+
+    throttle_codes = (421, 451)
+
+    def __init__(self, messages_per_second=None, recipients_per_second=None,
+                 max_connections=None, burst=None, backoff=0.5,
+                 recovery=0.05, min_rate=0.05):
+        self.buckets = []
+        for rate in (messages_per_second, recipients_per_second):
+            if rate is not None:
+                self.buckets.append((TokenBucket(rate, burst), rate))
+            else:
+                self.buckets.append((None, None))
+        self.max_connections = max_connections
+        self.backoff = backoff
+        self.recovery = recovery
+        self.min_rate = min_rate
+        #: number of connections in use
+        self.connections = 0
+        self._cond = threading.Condition()
+        self._waiters = []
+
+    @property
+    def rates(self):
+        """The current (messages, recipients) per second, None if unlimited.
+        """
+        return tuple(bucket and bucket.rate for bucket, _ in self.buckets)
+
+    def reserve(self, recipients=1):
+        """Book one message with the given number of recipients, returns the
+        seconds to wait before sending it.
+        """
+        delays = [0.0]
+        for (bucket, _), tokens in zip(self.buckets, (1, recipients)):
+            if bucket is not None:
+                delays.append(bucket.reserve(tokens))
+        return max(delays)
+
+    def wait(self, recipients=1):
+        """Block until one message with the given number of recipients may
+        be sent.
+        """
+        delay = self.reserve(recipients)
+        if delay > 0:
+            time.sleep(delay)
+
+    def feedback(self, codes):
+        """Adapt the rates to the SMTP reply codes of one send.
+        """
+        throttled = any(code in self.throttle_codes for code in codes)
+        for bucket, rate in self.buckets:
+            if bucket is None:
+                continue
+            with bucket._lock:
+                if throttled:
+                    bucket.rate = max(rate * self.min_rate,
+                                      bucket.rate * self.backoff)
+                else:
+                    bucket.rate = min(rate,
+                                      bucket.rate + rate * self.recovery)
+
+    def try_open_connection(self, callback=None):
+        """Take one connection slot if one is free and return True.
+        Otherwise return False, and if given call ``callback`` from the
+        thread that frees the next slot.
+        """
+        with self._cond:
+            if self.max_connections is None or \
+                    self.connections < self.max_connections:
+                self.connections += 1
+                return True
+            if callback is not None:
+                self._waiters.append(callback)
+            return False
+
+    def open_connection(self):
+        """Block until one connection slot is free and take it.
+        """
+        with self._cond:
+            while self.max_connections is not None and \
+                    self.connections >= self.max_connections:
+                self._cond.wait()
+            self.connections += 1
+
+    def close_connection(self):
+        """Give one connection slot back.
+        """
+        with self._cond:
+            self.connections -= 1
+            self._cond.notify()
+            waiters, self._waiters = self._waiters, []
+        for callback in waiters:
+            callback()
+
+
+def is_broken(error):
+    """Whether the SMTP session is unusable after one error.
+    """
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code == 421
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    return not isinstance(error, smtplib.SMTPException) and \
+        isinstance(error, socket.error)
 
 
 class AddressAttribute(object):
@@ -202,11 +1966,16 @@ class Message(object):
     bcc = AddressAttribute('bcc')
     reply_to = AddressAttribute('reply_to')
 
+    _shared_parts = None
+    _rendered = None
+    # set by Mail.prepare, see fast_render
+    _renderer = None
+
     def __init__(self, subject=None, to=None, body=None, html=None,
                  fromaddr=None, cc=None, bcc=None, attachments=None,
                  reply_to=None, date=None, charset='utf-8',
                  extra_headers=None, mail_options=None, rcpt_options=None):
-        self.message_id = make_msgid()
+        self._message_id = None
         self.subject = subject
         self.body = body
         self.html = html
@@ -225,6 +1994,33 @@ class Message(object):
         self.bcc = bcc or []
         self.reply_to = reply_to
 
+    def __getstate__(self):
+        # neither the render cache nor the parts shared by id are of any
+        # use to another process
+        state = self.__dict__.copy()
+        state.pop('_rendered', None)
+        state.pop('_shared_parts', None)
+        return state
+
+    def __setattr__(self, name, value):
+        # any change to a public field makes the rendered message stale
+        if not name.startswith('_'):
+            object.__setattr__(self, '_rendered', None)
+        object.__setattr__(self, name, value)
+
+    @property
+    def message_id(self):
+        """The Message-ID header, made by :data:`make_message_id` the first
+        time it is needed.
+        """
+        if self._message_id is None:
+            self._message_id = make_message_id()
+        return self._message_id
+
+    @message_id.setter
+    def message_id(self, value):
+        self._message_id = value
+
     @property
     def to_addrs(self):
         return self.to | self.cc | self.bcc
@@ -241,10 +2037,98 @@ class Message(object):
                 raise SenderError('newline is not allowed in subject')
 
     def as_string(self):
-        """The message string.
+        """The message string, decoded from :meth:`as_bytes`.  The wire
+        format is ASCII, so it is decoded as such whatever the charset of the
+        message is, 8bit text parts as UTF-8 and other bytes are kept as
+        surrogate escapes.
         """
+        cache = self._cache()
+        if 'string' not in cache:
+            data = self.as_bytes()
+            cache['string'] = data if PY2 else data.decode('utf-8',
+                                                           'surrogateescape')
+        return cache['string']
+
+    def as_bytes(self):
+        """The message bytes.  They are rendered once and cached until one
+        field of the message changes, so repeated sends and retries cost
+        nothing extra.  Attachments are not watched, call :meth:`attach` or
+        assign :attr:`attachments` again after changing one in place.
+        """
+        cache = self._cache()
+        if 'bytes' not in cache:
+            data = None
+            if self._renderer == 'fast':
+                # None when the message needs the email package
+                data = fast_render(self)
+            if data is None:
+                data = b''.join(self._iter_skeleton())
+            cache['bytes'] = data
+        return cache['bytes']
+
+    @property
+    def has_streams(self):
+        """Whether some attachment is streamed from one file.
+        """
+        return any(a.is_stream for a in self.attachments)
+
+    def iter_bytes(self):
+        """Iterate over the message bytes in chunks.  Attachments streamed
+        from files are read and base64 encoded one chunk at a time, so they
+        are never held in memory as a whole.
+        """
+        if not self.has_streams:
+            return iter([self.as_bytes()])
+        return self._iter_skeleton()
+
+    def _iter_skeleton(self):
+        for item in self._skeleton():
+            if isinstance(item, Attachment):
+                for chunk in item.iter_encoded():
+                    yield chunk
+            else:
+                yield item
+
+    def _skeleton(self):
+        # the rendered message cut around the base64 payloads of buffer and
+        # stream attachments, which are left out of the email generator and
+        # joined in afterwards
+        cache = self._cache()
+        if 'skeleton' not in cache:
+            markers = {}
+            data = self._render(markers)
+            if not markers:
+                cache['skeleton'] = [data]
+                return cache['skeleton']
+            skeleton = []
+            pattern = b'(' + b'|'.join(map(re.escape, markers)) + b')'
+            for i, segment in enumerate(re.split(pattern, data)):
+                if i % 2:
+                    skeleton.append(markers[segment])
+                elif segment:
+                    skeleton.append(segment)
+            cache['skeleton'] = skeleton
+        return cache['skeleton']
+
+    def _cache(self):
         if self.date is None:
             self.date = time.time()
+        key = self._render_key()
+        if self._rendered is None or self._rendered['key'] != key:
+            self._rendered = {'key': key}
+        return self._rendered
+
+    def _render_key(self):
+        # in-place changes of these containers do not go through
+        # __setattr__, so they are part of the cache key
+        headers = self.extra_headers
+        return (tuple(map(id, self.attachments)),
+                tuple(sorted(headers.items())) if headers else None,
+                self._renderer)
+
+    def _render(self, markers):
+        # parts rendered once and shared by all messages of one template
+        shared = self._shared_parts or {}
 
         if not self.html:
             if len(self.attachments) == 0:
@@ -253,13 +2137,17 @@ class Message(object):
             elif len(self.attachments) > 0:
                 # plain text with attachments
                 msg = MIMEMultipart()
-                msg.attach(MIMEText(self.body, 'plain', self.charset))
+                if 'body' in shared:
+                    msg.attach(shared['body'])
+                else:
+                    msg.attach(MIMEText(self.body, 'plain', self.charset))
         else:
             msg = MIMEMultipart()
-            alternative = MIMEMultipart('alternative')
-            alternative.attach(MIMEText(self.body, 'plain', self.charset))
-            alternative.attach(MIMEText(self.html, 'html', self.charset))
-            msg.attach(alternative)
+            if 'alternative' in shared:
+                msg.attach(shared['alternative'])
+            else:
+                msg.attach(make_alternative_part(self.body, self.html,
+                                                 self.charset))
 
         msg['Subject'] = Header(self.subject, self.charset)
         msg['From'] = self.fromaddr
@@ -275,29 +2163,22 @@ class Message(object):
                 msg[key] = value
 
         for attachment in self.attachments:
-            f = MIMEBase(*attachment.content_type.split('/'))
-            f.set_payload(attachment.data)
-            encode_base64(f)
-            if attachment.filename is None:
-                filename = str(None)
+            marker = None
+            if attachment.is_buffer or attachment.is_stream:
+                marker = _payload_marker(attachment)
+                markers[marker.encode('ascii')] = attachment
+            if id(attachment) in shared:
+                msg.attach(shared[id(attachment)])
             else:
-                filename = force_text(attachment.filename, self.charset)
-            try:
-                filename.encode('ascii')
-            except UnicodeEncodeError:
-                if PY2:
-                    filename = filename.encode('utf-8')
-                filename = ('UTF8', '', filename)
-            f.add_header('Content-Disposition', attachment.disposition,
-                         filename=filename)
-            for key, value in attachment.headers.items():
-                f.add_header(key, value)
-            msg.attach(f)
-
-        return msg.as_string()
+                msg.attach(make_attachment_part(attachment, self.charset,
+                                                marker))
 
-    def as_bytes(self):
-        return self.as_string().encode(self.charset or 'utf-8')
+        if PY2:
+            return msg.as_string()
+        # straight to bytes, the 8bit text parts are never decoded to str
+        buf = BytesIO()
+        BytesGenerator(buf, mangle_from_=False, maxheaderlen=0).flatten(msg)
+        return buf.getvalue()
 
     def __str__(self):
         return self.as_string()
@@ -312,6 +2193,7 @@ class Message(object):
         except TypeError:
             attachments = [attachment_or_attachments]
         self.attachments.extend(attachments)
+        self._rendered = None
 
     def attach_attachment(self, *args, **kwargs):
         """Shortcut for attach.
@@ -319,23 +2201,653 @@ class Message(object):
         self.attach(Attachment(*args, **kwargs))
 
 
+# (lock, first position) of the file objects streamed, shared by all the
+# attachments reading one of them
+_stream_states = weakref.WeakKeyDictionary()
+_stream_states_lock = threading.Lock()
+
+
+def _stream_state(f):
+    with _stream_states_lock:
+        try:
+            state = _stream_states.get(f)
+        except TypeError:
+            # can not be weakly referenced, nor shared safely
+            state = None
+        if state is not None:
+            return state
+        try:
+            position = f.tell()
+        except (AttributeError, IOError, OSError):
+            position = None
+        state = (threading.Lock(), position)
+        try:
+            _stream_states[f] = state
+        except TypeError:
+            pass
+        return state
+
+
 class Attachment(object):
     """File attachment information.
 
     :param filename: filename
     :param content_type: file mimetype
-    :param data: raw data
+    :param data: raw data, which may be one ``bytes``, ``memoryview`` or
+                 ``mmap`` buffer, or one file object opened in binary mode
+                 which is streamed when the message is sent
     :param disposition: content-disposition, default to be 'attachment'
     :param headers: a dictionary of headers, default to be {}
+    :param path: path of one file which is streamed when the message is
+                 sent, instead of data
     """
 
+    #: raw bytes read from streamed files at a time, a multiple of 57 so
+    #: that every chunk encodes to whole base64 lines
+    chunk_size = 57 * 1024
+
     def __init__(self, filename=None, content_type=None, data=None,
-                 disposition='attachment', headers={}):
+                 disposition='attachment', headers={}, path=None):
         self.filename = filename
         self.content_type = content_type
         self.data = data
         self.disposition = disposition
         self.headers = headers
+        self.path = path
+        self._encoded = None
+
+    @property
+    def is_stream(self):
+        """Whether the data is streamed from one file.
+        """
+        return self.path is not None or (hasattr(self.data, 'read') and
+                                         not isinstance(self.data, mmap.mmap))
+
+    @property
+    def is_buffer(self):
+        """Whether the data is one binary buffer that can be encoded without
+        copying it first.
+        """
+        return not PY2 and isinstance(self.data, (bytes, bytearray,
+                                                  memoryview, mmap.mmap))
+
+    def encoded(self):
+        """The base64 encoded bytes of one buffer, they are computed
+        once.  Attachments with the same data and content type share one
+        encoding kept in :data:`encoding_cache`, and attachments built from
+        the same ``memoryview`` or ``mmap`` object are not even hashed
+        again, so the buffer must not change while messages using it are
+        sent.
+        """
+        data = self.data
+        cached = self._encoded
+        if cached is not None and cached[0] is data:
+            return cached[1]
+        encoded = _encode_buffer(data, self.content_type)
+        self._encoded = (data, encoded)
+        return encoded
+
+    def read(self):
+        """The raw data, streamed files are read as a whole.
+        """
+        if not self.is_stream:
+            return self.data
+        return b''.join(self.iter_data())
+
+    def iter_data(self):
+        """Iterate over the raw data in chunks.  One file object is read
+        from the position it had the first time, so it can be sent again.
+        """
+        if not self.is_stream:
+            yield self.data
+            return
+        if self.path is not None:
+            with open(self.path, 'rb') as f:
+                while True:
+                    chunk = f.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            return
+        # one file object may be sent by many messages at the same time:
+        # each reader keeps its own position, and seeks to it before every
+        # read under the lock of the file
+        f = self.data
+        lock, position = _stream_state(f)
+        while True:
+            with lock:
+                if position is not None:
+                    f.seek(position)
+                chunk = f.read(self.chunk_size)
+            if not chunk:
+                break
+            if position is not None:
+                position += len(chunk)
+            yield chunk
+
+    def iter_encoded(self):
+        """Iterate over the base64 encoded data in chunks of whole lines.
+        """
+        if self.is_buffer:
+            yield self.encoded()
+            return
+        rest = b''
+        for chunk in self.iter_data():
+            if rest:
+                chunk = rest + chunk
+            cut = len(chunk) - len(chunk) % 57
+            rest = chunk[cut:]
+            if cut:
+                yield encodebytes(chunk[:cut])
+        if rest:
+            yield encodebytes(rest)
+
+
+class MessageTemplate(object):
+    """A message for mail merge.  ``subject``, ``body`` and ``html`` may
+    contain ``$name`` placeholders (:class:`string.Template` syntax) that are
+    filled in from each row.  Attachments, and the text parts without any
+    placeholder, are rendered and encoded once and shared by every message
+    made from this template, so do not change the template after the first
+    :meth:`render`.
+
+    It takes the same parameters as :class:`Message`, except the recipients
+    which come with each row.
+    """
+
+    def __init__(self, subject=None, body=None, html=None, fromaddr=None,
+                 attachments=None, reply_to=None, charset='utf-8',
+                 extra_headers=None, mail_options=None, rcpt_options=None):
+        self.subject = subject
+        self.body = body
+        self.html = html
+        self.fromaddr = fromaddr
+        self.attachments = attachments or []
+        self.reply_to = reply_to
+        self.charset = charset
+        self.extra_headers = extra_headers
+        self.mail_options = mail_options or []
+        self.rcpt_options = rcpt_options or []
+        self._shared_parts = None
+        self._lock = threading.Lock()
+
+    def render(self, row):
+        """Make one message for one row.
+
+        :param row: a dictionary with the recipients ``to``, ``cc`` and
+                    ``bcc``, and the values of the placeholders
+        """
+        msg = Message(subject=self._substitute(self.subject, row),
+                      to=row.get('to'),
+                      body=self._substitute(self.body, row),
+                      html=self._substitute(self.html, row),
+                      fromaddr=self.fromaddr, cc=row.get('cc'),
+                      bcc=row.get('bcc'),
+                      attachments=list(self.attachments),
+                      reply_to=self.reply_to, charset=self.charset,
+                      extra_headers=self.extra_headers,
+                      mail_options=self.mail_options,
+                      rcpt_options=self.rcpt_options)
+        msg._shared_parts = self.shared_parts
+        return msg
+
+    @property
+    def shared_parts(self):
+        """The MIME parts that are the same for all messages.
+        """
+        with self._lock:
+            if self._shared_parts is None:
+                self._shared_parts = self._make_shared_parts()
+        return self._shared_parts
+
+    def _make_shared_parts(self):
+        if _has_placeholders(self.body) or _has_placeholders(self.html):
+            return make_shared_parts(None, None, self.attachments,
+                                     self.charset)
+        return make_shared_parts(self.body, self.html, self.attachments,
+                                 self.charset)
+
+    def _substitute(self, text, row):
+        if not text:
+            return text
+        return string.Template(text).substitute(row)
+
+
+class MessageBatch(object):
+    """Many messages that differ only in their ``to`` recipients, stored as
+    one message and one column of recipients.  Messages are made one at a
+    time while the batch is iterated, so one queued message costs little
+    more memory than its recipient address.  Send it with :meth:`Mail.send`
+    like any iterable of messages.
+
+    :param message: the message shared by the batch, its ``to`` recipients
+                    are replaced by each recipient of the batch
+    :param recipients: an iterable of ``to`` recipients, each one should be
+                       one or a list of addresses
+    """
+
+    def __init__(self, message, recipients=None):
+        self.message = message
+        self.recipients = list(recipients or [])
+        self._shared_parts = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.recipients)
+
+    def __iter__(self):
+        message = self.message
+        shared = self.shared_parts
+        for to in self.recipients:
+            msg = Message(message.subject, to=to, body=message.body,
+                          html=message.html,
+                          attachments=list(message.attachments),
+                          date=message.date, charset=message.charset,
+                          extra_headers=message.extra_headers,
+                          mail_options=message.mail_options,
+                          rcpt_options=message.rcpt_options)
+            # already processed, so they are copied as they are
+            msg.addrs.update(fromaddr=message.fromaddr, cc=message.cc,
+                             bcc=message.bcc, reply_to=message.reply_to)
+            msg._shared_parts = shared
+            yield msg
+
+    def append(self, recipient):
+        """Adds one recipient, that is one more message, to the batch.
+        """
+        self.recipients.append(recipient)
+
+    @property
+    def shared_parts(self):
+        """The MIME parts that are the same for all messages.
+        """
+        with self._lock:
+            if self._shared_parts is None:
+                message = self.message
+                self._shared_parts = make_shared_parts(
+                    message.body, message.html, message.attachments,
+                    message.charset)
+        return self._shared_parts
+
+
+class RawMessage(object):
+    """One message that is already rendered, it can be sent like one
+    :class:`Message` instance.
+
+    :param fromaddr: envelope sender
+    :param to_addrs: a list of envelope recipients
+    :param data: the message bytes
+    :param mail_options: a list of ESMTP options used in MAIL FROM commands
+    :param rcpt_options: a list of ESMTP options used in RCPT commands
+    """
+
+    has_streams = False
+
+    def __init__(self, fromaddr, to_addrs, data, mail_options=None,
+                 rcpt_options=None):
+        self.fromaddr = fromaddr
+        self.to_addrs = to_addrs
+        self.data = data
+        self.mail_options = mail_options or []
+        self.rcpt_options = rcpt_options or []
+
+    def validate(self):
+        if not self.to_addrs:
+            raise SenderError("does not specify any recipients(to,cc,bcc)")
+        if not self.fromaddr:
+            raise SenderError("does not specify fromaddr(sender)")
+
+    def as_bytes(self):
+        return self.data
+
+    def iter_bytes(self):
+        yield self.data
+
+    def __str__(self):
+        return self.data if PY2 else self.data.decode('utf-8', 'replace')
+
+
+class Envelope(object):
+    """One message sent again to some of its recipients only.
+
+    :param message: one message instance
+    :param to_addrs: the recipients
+    """
+
+    def __init__(self, message, to_addrs):
+        self.message = message
+        self.to_addrs = to_addrs
+
+    def __getattr__(self, name):
+        return getattr(self.message, name)
+
+    def __str__(self):
+        return str(self.message)
+
+
+def split_recipients(message, size):
+    """Split the envelope of one message into chunks of at most ``size``
+    recipients, returns a list of :class:`Envelope` instances, or the
+    message itself if it fits in one transaction.
+
+    :param message: one message instance
+    :param size: the most recipients of one chunk, None means no limit
+    """
+    to_addrs = list(message.to_addrs)
+    if not size or len(to_addrs) <= size:
+        return [message]
+    return [Envelope(message, to_addrs[i:i + size])
+            for i in range(0, len(to_addrs), size)]
+
+
+def group_by_domain(addresses):
+    """Group addresses by their domain, returns an ordered dictionary of
+    lower-cased domains to sorted lists of addresses.  Addresses may carry
+    display names, like ``'Tom <tom@example.com>'``.
+    """
+    domains = OrderedDict()
+    for address in sorted(addresses):
+        domain = parseaddr(address)[1].rpartition('@')[2].lower()
+        domains.setdefault(domain, []).append(address)
+    return domains
+
+
+def make_shared_parts(body, html, attachments, charset='utf-8'):
+    """Render the parts that are the same for many messages once.  Returns
+    a dictionary of the attachment parts by attachment id, and of the text
+    parts if ``body`` is given, which messages reuse when they are rendered.
+    """
+    parts = {}
+    for attachment in attachments:
+        if attachment.is_stream:
+            continue
+        marker = _payload_marker(attachment) if attachment.is_buffer else None
+        parts[id(attachment)] = make_attachment_part(attachment, charset,
+                                                     marker)
+    if body is None:
+        return parts
+    if html:
+        alternative = make_alternative_part(body, html, charset)
+        # fixes the boundary now, rendering must not change it later
+        alternative.as_string()
+        parts['alternative'] = alternative
+    else:
+        parts['body'] = MIMEText(body, 'plain', charset)
+    return parts
+
+
+def _has_placeholders(text):
+    if not text:
+        return False
+    for match in string.Template.pattern.finditer(text):
+        if match.group('named') or match.group('braced'):
+            return True
+    return False
+
+
+def make_alternative_part(body, html, charset='utf-8'):
+    """Make the multipart/alternative part of one plain text body and one
+    HTML body.
+    """
+    alternative = MIMEMultipart('alternative')
+    alternative.attach(MIMEText(body, 'plain', charset))
+    alternative.attach(MIMEText(html, 'html', charset))
+    return alternative
+
+
+def _payload_marker(attachment):
+    # the line that stands in for the base64 payload of one attachment while
+    # messages are rendered, see Message._skeleton
+    return 'sender-payload-%s-%x\n' % (_marker_prefix, id(attachment))
+
+
+# unique to this process, rendered text can not fake one marker
+_marker_prefix = uuid.uuid4().hex
+
+
+def make_attachment_part(attachment, charset='utf-8', marker=None):
+    """Make the base64 encoded MIME part of one attachment.
+
+    :param attachment: one attachment instance
+    :param charset: charset used for non-ASCII filenames
+    :param marker: if given, it takes the place of the payload, which is
+                   streamed later on
+    """
+    f = MIMEBase(*attachment.content_type.split('/'))
+    if marker is not None:
+        f.set_payload(marker)
+        f['Content-Transfer-Encoding'] = 'base64'
+    elif attachment.is_buffer:
+        f.set_payload(attachment.encoded())
+        f['Content-Transfer-Encoding'] = 'base64'
+    else:
+        f.set_payload(attachment.read())
+        encode_base64(f)
+    if attachment.filename is None:
+        filename = str(None)
+    else:
+        filename = force_text(attachment.filename, charset)
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        if PY2:
+            filename = filename.encode('utf-8')
+        filename = ('UTF8', '', filename)
+    f.add_header('Content-Disposition', attachment.disposition,
+                 filename=filename)
+    for key, value in attachment.headers.items():
+        f.add_header(key, value)
+    return f
+
+
+# line breaks that the email generator turns into plain newlines
+_line_breaks = re.compile(r'\r\n|\r')
+
+# the multipart boundary format of the email generator
+_boundary_format = '=' * 15 + '%%0%dd' % len(repr(sys.maxsize - 1)) + '=='
+
+
+def fast_render(message):
+    """Render one message straight into bytes, without building the MIME
+    objects of the :mod:`email` package and running its generator.  The
+    output is byte for byte what :meth:`Message.as_bytes` makes with the
+    email package, the multipart boundaries are drawn from :mod:`random` in
+    the same order too.  Text parts are written as they are, or quoted
+    printable or base64 encoded, as the charset of the message says.
+
+    Returns None for the messages it does not handle, which are then
+    rendered with the email package: on Python 2, with a charset alias or
+    one converted to another one for output, or with attachments made from
+    text.
+
+    :param message: one message instance
+    """
+    if PY2 or not message.charset:
+        return None
+    encoding = message.charset
+    text_charset = Charset(encoding)
+    # MIMEText writes the charset param again for aliases such as 'UTF-8',
+    # which moves the Content-Type header
+    if text_charset.input_charset != encoding:
+        return None
+    if text_charset.get_output_charset() != text_charset.input_charset:
+        return None
+    headers = [('Subject', Header(message.subject, encoding)),
+               ('From', message.fromaddr),
+               ('To', ', '.join(message.to)),
+               ('Date', formatdate(message.date, localtime=True)),
+               ('Message-ID', message.message_id)]
+    if message.cc:
+        headers.append(('Cc', ', '.join(message.cc)))
+    if message.reply_to:
+        headers.append(('Reply-To', message.reply_to))
+    if message.extra_headers:
+        headers.extend(message.extra_headers.items())
+    # values the email package would fail on are left to it
+    values = [value for name, value in headers]
+    for attachment in message.attachments:
+        if not (attachment.is_buffer or attachment.is_stream):
+            return None
+        if attachment.content_type.count('/') != 1:
+            return None
+        values.extend(attachment.headers.values())
+    if not all(isinstance(v, string_types + (Header,)) for v in values):
+        return None
+    head = ''.join([_fold_header(name, value) for name, value in headers])
+
+    if not message.html and not message.attachments:
+        return b''.join(_text_part(message.body, 'plain', text_charset,
+                                   encoding, head))
+    if message.html:
+        parts = [_multipart('alternative', [
+            _text_part(message.body, 'plain', text_charset, encoding),
+            _text_part(message.html, 'html', text_charset, encoding)],
+            encoding)]
+    else:
+        parts = [_text_part(message.body, 'plain', text_charset, encoding)]
+    for attachment in message.attachments:
+        parts.append(_attachment_part(attachment, encoding))
+    return b''.join(_multipart('mixed', parts, encoding, head))
+
+
+def _fold_header(name, value):
+    # the header line written by the generator of Message.as_string, which
+    # does not fold long lines
+    if isinstance(value, Header):
+        value = value.encode(linesep='\n', maxlinelen=0)
+    elif '\n' in value or '\r' in value:
+        value = Header(value, header_name=name).encode(linesep='\n',
+                                                       maxlinelen=0)
+    else:
+        try:
+            value.encode('ascii')
+        except UnicodeEncodeError:
+            value = Header(value, header_name=name).encode(linesep='\n',
+                                                           maxlinelen=0)
+    return '%s: %s\n' % (name, value)
+
+
+def _text_part(text, subtype, text_charset, encoding, head=''):
+    # the chunks of one MIMEText part
+    text = text or ''
+    if text_charset.body_encoding is None:
+        # judged on the encoded text, iso-2022-jp is 7bit for any text
+        try:
+            text.encode(encoding).decode('ascii')
+            cte = '7bit'
+        except UnicodeDecodeError:
+            cte = '8bit'
+    else:
+        cte = text_charset.get_body_encoding()
+        if text:
+            text = text_charset.body_encode(
+                text.encode(text_charset.output_charset))
+    if '\r' in text:
+        text = _line_breaks.sub('\n', text)
+    return [('Content-Type: text/%s; charset="%s"\n'
+             'MIME-Version: 1.0\n'
+             'Content-Transfer-Encoding: %s\n%s\n'
+             % (subtype, text_charset.get_output_charset(), cte,
+                head)).encode(encoding),
+            text.encode(encoding)]
+
+
+def _attachment_part(attachment, encoding):
+    # the chunks of one part made by make_attachment_part
+    if attachment.is_buffer:
+        payload = attachment.encoded()
+    else:
+        payload = encodebytes(attachment.read())
+    if attachment.filename is None:
+        filename = str(None)
+    else:
+        filename = force_text(attachment.filename, encoding)
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        param = 'filename*=%s' % encode_rfc2231(filename, 'UTF8', '')
+    else:
+        param = 'filename="%s"' % quote(filename) if filename else 'filename'
+    if attachment.disposition is not None:
+        param = '%s; %s' % (attachment.disposition, param)
+    lines = ['Content-Type: %s\n' % attachment.content_type,
+             'MIME-Version: 1.0\n',
+             'Content-Transfer-Encoding: base64\n',
+             _fold_header('Content-Disposition', param)]
+    for key, value in attachment.headers.items():
+        lines.append(_fold_header(key, value))
+    lines.append('\n')
+    return [''.join(lines).encode(encoding), payload]
+
+
+def _multipart(subtype, parts, encoding, head=''):
+    # the chunks of one MIMEMultipart made of parts rendered already
+    boundary = _make_boundary(parts)
+    chunks = [('Content-Type: multipart/%s; boundary="%s"\n'
+               'MIME-Version: 1.0\n%s\n--%s\n'
+               % (subtype, boundary, head, boundary)).encode(encoding)]
+    delimiter = ('\n--%s\n' % boundary).encode('ascii')
+    for i, part in enumerate(parts):
+        if i:
+            chunks.append(delimiter)
+        chunks.extend(part)
+    chunks.append(('\n--%s--\n' % boundary).encode('ascii'))
+    return chunks
+
+
+def _make_boundary(parts):
+    boundary = _boundary_format % random.randrange(sys.maxsize)
+    b = boundary
+    counter = 0
+    while _has_boundary(parts, b):
+        b = boundary + '.' + str(counter)
+        counter += 1
+    return b
+
+
+def _has_boundary(parts, boundary):
+    marker = ('--' + boundary).encode('ascii')
+    if not any(marker in chunk for part in parts for chunk in part):
+        return False
+    text = b'\n'.join(b''.join(part) for part in parts)
+    pattern = b'^' + re.escape(marker) + b'(--)?$'
+    return re.search(pattern, text, re.MULTILINE) is not None
+
+
+# id of one buffer object -> (weak reference to it, base64 encoded bytes)
+_encoded_buffers = {}
+
+
+def _encode_buffer(data, content_type=None):
+    key = id(data)
+    entry = _encoded_buffers.get(key)
+    if entry is not None and entry[0]() is data:
+        return entry[1]
+    # binascii and hashlib read memoryview and mmap buffers in place, no copy
+    # is made
+    view = memoryview(data).cast('B')
+    digest = (hashlib.sha1(view).hexdigest(), content_type)
+    encoded = encoding_cache.get(digest)
+    if encoded is None:
+        # encoding in slices of whole lines keeps the temporary line objects
+        # of encodebytes few
+        size = Attachment.chunk_size
+        encoded = b''.join([encodebytes(view[i:i + size])
+                            for i in range(0, len(view), size)])
+        encoding_cache.set(digest, encoded)
+    try:
+        ref = weakref.ref(data, lambda ref: _forget_buffer(key, ref))
+    except TypeError:
+        # bytes and bytearray can not be weakly referenced
+        return encoded
+    _encoded_buffers[key] = (ref, encoded)
+    return encoded
+
+
+def _forget_buffer(key, ref):
+    entry = _encoded_buffers.get(key)
+    if entry is not None and entry[0] is ref:
+        del _encoded_buffers[key]
 
 
 def parse_fromaddr(fromaddr):
@@ -403,11 +2915,140 @@ def force_text(s, encoding='utf-8', errors='strict'):
     return s
 
 
+class MessageIDGenerator(object):
+    """Makes unique Message-ID values quickly.  The domain is looked up
+    only once, and each id is one random prefix, the process id and one
+    counter value, so no DNS lookup or random number is needed per message.
+
+    :param domain: domain part of the ids, default to be the fully qualified
+                   name of this host
+    """
+
+    def __init__(self, domain=None):
+        self._domain = domain
+        self._prefix = '%d.%016x' % (time.time(), random.getrandbits(64))
+        self._counter = itertools.count()
+
+    @property
+    def domain(self):
+        if self._domain is None:
+            self._domain = socket.getfqdn()
+        return self._domain
+
+    def __call__(self):
+        return '<%s.%d.%d@%s>' % (self._prefix, os.getpid(),
+                                  next(self._counter), self.domain)
+
+
+#: the default Message-ID generator, see :class:`MessageIDGenerator`
+make_message_id = MessageIDGenerator()
+
+
+class LRUCache(object):
+    """A thread-safe, bounded cache that drops the least recently used
+    entries first and counts its hits and misses.
+
+    :param maxsize: the most entries kept
+    :param maxbytes: if given, the most bytes of values kept, values bigger
+                     than this are not kept at all
+    """
+
+    def __init__(self, maxsize=1024, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        #: the bytes of the values kept, counted if there is ``maxbytes``
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hit_rate(self):
+        """The share of lookups that were hits, 0.0 before the first one.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else 0.0
+
+    def get(self, key, default=None):
+        """Returns the value of one key and marks it as recently used.
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._discard(key)
+            if self.maxbytes is not None:
+                if len(value) > self.maxbytes:
+                    return
+                self.bytes += len(value)
+            self._data[key] = value
+            while len(self._data) > self.maxsize or \
+                    (self.maxbytes is not None and
+                     self.bytes > self.maxbytes):
+                self._discard(next(iter(self._data)))
+
+    def _discard(self, key):
+        value = self._data.pop(key, None)
+        if value is not None and self.maxbytes is not None:
+            self.bytes -= len(value)
+
+    def clear(self):
+        """Drops all entries and resets the statistics.
+        """
+        with self._lock:
+            self._data.clear()
+            self.bytes = self.hits = self.misses = 0
+
+    def info(self):
+        """Returns a dictionary of the cache statistics.
+        """
+        info = {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hit_rate, 'size': len(self._data),
+                'maxsize': self.maxsize}
+        if self.maxbytes is not None:
+            info.update(bytes=self.bytes, maxbytes=self.maxbytes)
+        return info
+
+
+#: normalized addresses by (address, encoding), see :func:`process_address`
+address_cache = LRUCache(4096)
+
+#: base64 encoded attachment data by (SHA-1 digest, content type), shared by
+#: all the attachments with the same content, see :meth:`Attachment.encoded`
+encoding_cache = LRUCache(1024, maxbytes=64 * 1024 * 1024)
+
+
 def process_address(address, encoding='utf-8'):
-    """Process one email address.
+    """Process one email address.  Results are kept in
+    :data:`address_cache`, so repeated addresses are almost free.
 
     :param address: email from-address string
     """
+    try:
+        key = (address, encoding)
+        processed = address_cache.get(key)
+    except TypeError:
+        # unhashable, not worth caching
+        return _process_address(address, encoding)
+    if processed is None:
+        processed = _process_address(address, encoding)
+        address_cache.set(key, processed)
+    return processed
+
+
+def _process_address(address, encoding):
     name, addr = parseaddr(force_text(address, encoding))
 
     try:
@@ -429,3 +3070,99 @@ def process_address(address, encoding='utf-8'):
 
 def process_addresses(addresses, encoding='utf-8'):
     return map(lambda e: process_address(e, encoding), addresses)
+
+
+def envelope_commands(fromaddr, to_addrs, mail_options=(),
+                      rcpt_options=()):
+    """Build the MAIL, RCPT and DATA commands of one SMTP transaction.
+
+    :param fromaddr: envelope sender
+    :param to_addrs: a list of envelope recipients
+    :param mail_options: a list of ESMTP options used in MAIL FROM commands
+    :param rcpt_options: a list of ESMTP options used in RCPT commands
+    """
+    commands = ['mail FROM:%s%s' % (smtplib.quoteaddr(fromaddr),
+                                    _format_options(mail_options))]
+    for addr in to_addrs:
+        commands.append('rcpt TO:%s%s' % (smtplib.quoteaddr(addr),
+                                          _format_options(rcpt_options)))
+    commands.append('data')
+    return commands
+
+
+def check_envelope(fromaddr, to_addrs, replies):
+    """Check the replies to the commands got from :func:`envelope_commands`,
+    returns the refused recipients dictionary and the error that aborts the
+    transaction, if any.
+
+    :param fromaddr: envelope sender
+    :param to_addrs: a list of envelope recipients
+    :param replies: a list of (code, message) replies in command order
+    """
+    code, resp = replies[0]
+    if code != 250:
+        return {}, smtplib.SMTPSenderRefused(code, resp, fromaddr)
+    refused = {}
+    for addr, (code, resp) in zip(to_addrs, replies[1:]):
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    if len(refused) == len(to_addrs):
+        return refused, smtplib.SMTPRecipientsRefused(refused)
+    code, resp = replies[-1]
+    if code != 354:
+        return refused, smtplib.SMTPDataError(code, resp)
+    return refused, None
+
+
+def _format_options(options):
+    if not options:
+        return ''
+    return ' ' + ' '.join(options)
+
+
+_eol_re = re.compile(br'\r\n|\n|\r(?!\n)')
+_period_re = re.compile(br'(?m)^\.')
+
+
+def quote_data(data):
+    """Make message bytes ready for the SMTP ``DATA`` command: line endings
+    become CRLF, lines starting with a period are escaped and the
+    terminating ``.`` line is appended.
+
+    :param data: message bytes
+    """
+    data = _period_re.sub(b'..', _eol_re.sub(b'\r\n', data))
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return data + b'.\r\n'
+
+
+def quote_chunks(chunks):
+    """Like :func:`quote_data`, but for message bytes coming in chunks,
+    yields the quoted chunks.
+
+    :param chunks: an iterable of message bytes
+    """
+    line_start = True
+    pending_cr = False
+    # held back one step, so the terminating line goes out with the last one
+    last = b''
+    for chunk in chunks:
+        if pending_cr:
+            chunk = b'\r' + chunk
+        # one CRLF may be split between two chunks
+        pending_cr = chunk.endswith(b'\r')
+        if pending_cr:
+            chunk = chunk[:-1]
+        if not chunk:
+            continue
+        chunk = _eol_re.sub(b'\r\n', chunk).replace(b'\n.', b'\n..')
+        if line_start and chunk.startswith(b'.'):
+            chunk = b'.' + chunk
+        line_start = chunk.endswith(b'\n')
+        if last:
+            yield last
+        last = chunk
+    if pending_cr or not line_start:
+        last += b'\r\n'
+    yield last + b'.\r\n'
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+"""
+    sender_async
+    ~~~~~~~~~~~~
+
+    Native asyncio SMTP client for Sender, Python 3.5+ only.
+
+    :copyright: (c) 2016 by Shipeng Feng.
+    :license: BSD, see LICENSE for more details.
+"""
+import asyncio
+import base64
+import ssl
+import time
+from smtplib import SMTPException, SMTPConnectError, SMTPServerDisconnected, \
+    SMTPResponseException, SMTPHeloError, SMTPAuthenticationError, \
+    SMTPNotSupportedError, SMTPDataError, SMTPRecipientsRefused
+
+from sender import Mail, Message, SendResult, SenderError, \
+    envelope_commands, check_envelope, quote_chunks, reply_codes, is_broken, \
+    refused_by, split_recipients
+
+
+class AsyncMail(Mail):
+    """Asyncio version of :class:`sender.Mail`, it takes the same arguments
+    except that connection pooling, retries, direct delivery and the spool
+    are not supported.
+    :meth:`send` is a coroutine, so many deliveries can be in flight on one
+    event loop.  Each of them opens one session, ``max_connections`` caps
+    how many are open at the same time, the others wait for their turn::
+
+        mail = AsyncMail('localhost', max_connections=10)
+        await asyncio.gather(*[mail.send(msg) for msg in messages])
+    """
+
+    def __init__(self, *args, **kwargs):
+        Mail.__init__(self, *args, **kwargs)
+        # (event loop, semaphore) bounding the open sessions
+        self._sessions = None
+        if self.pool is not None:
+            raise SenderError('connection pool is not supported by AsyncMail')
+        if self.retry is not None:
+            raise SenderError('retry is not supported by AsyncMail')
+        if self.direct:
+            raise SenderError('direct delivery is not supported by AsyncMail')
+        if self.spool is not None:
+            self.spool.close()
+            raise SenderError('spool is not supported by AsyncMail')
+
+    @property
+    def connection(self):
+        """Open one asyncio connection to the SMTP server.
+        """
+        return AsyncConnection(self)
+
+    def session_slots(self):
+        """The semaphore bounding the sessions open at the same time, None
+        if there is no ``max_connections``.  Asyncio primitives belong to
+        one event loop, so there is one semaphore per loop.
+        """
+        if self.max_connections is None:
+            return None
+        loop = asyncio.get_event_loop()
+        if self._sessions is None or self._sessions[0] is not loop:
+            self._sessions = (loop, asyncio.Semaphore(self.max_connections))
+        return self._sessions[1]
+
+    async def send(self, message_or_messages):
+        """Sends a single messsage or multiple messages over one connection.
+        Returns the result of :meth:`AsyncConnection.send` for one message,
+        or a list of them in the same order for multiple messages.
+
+        :param message_or_messages: one message instance or one iterable of
+                                    message instances.
+        """
+        try:
+            messages = iter(message_or_messages)
+        except TypeError:
+            return (await self.send([message_or_messages]))[0]
+
+        results = []
+        async with self.connection as c:
+            for message in messages:
+                self.prepare(message)
+                results.append(await c.send(message))
+        return results
+
+    async def send_message(self, *args, **kwargs):
+        """Shortcut for send.
+        """
+        return await self.send(Message(*args, **kwargs))
+
+    async def send_merge(self, template, rows):
+        """Mail merge, sends one message made from one template for each
+        row over one connection.  Returns the results just like
+        :meth:`send` does for multiple messages.
+
+        :param template: one :class:`sender.MessageTemplate` instance
+        :param rows: an iterable of dictionaries, see
+                     :meth:`sender.MessageTemplate.render`
+        """
+        return await self.send(template.render(row) for row in rows)
+
+    def stream(self, messages, concurrency=None, window=100,
+               render_processes=None):
+        """Streaming runs on worker threads, which AsyncMail does not have,
+        send the messages with :meth:`send` instead.
+        """
+        raise SenderError('stream is not supported by AsyncMail')
+
+
+class AsyncConnection(object):
+    """This class handles one asyncio connection to the SMTP server, it is
+    one asynchronous context manager.  Commands are pipelined if the server
+    supports the ``PIPELINING`` extension.
+
+    :param mail: one mail instance
+    :param metrics: one :class:`sender.Metrics` instance, default to be the
+                    one of the mail instance
+    """
+
+    def __init__(self, mail, metrics=None):
+        self.mail = mail
+        self.metrics = metrics if metrics is not None else mail.metrics
+        self.reader = None
+        self.writer = None
+        self.endpoint = None
+        self.esmtp_features = {}
+        self.slots = None
+
+    async def __aenter__(self):
+        self.slots = self.mail.session_slots()
+        if self.slots is not None:
+            await self.slots.acquire()
+        limiter = self.mail.rate_limiter
+        try:
+            if limiter is not None:
+                await open_connection_slot(limiter)
+            try:
+                await self.connect()
+            except Exception as e:
+                if limiter is not None:
+                    limiter.feedback(reply_codes(e))
+                    limiter.close_connection()
+                raise
+        except BaseException:
+            if self.slots is not None:
+                self.slots.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_tb):
+        try:
+            await self.quit()
+        finally:
+            if self.mail.rate_limiter is not None:
+                self.mail.rate_limiter.close_connection()
+            if self.slots is not None:
+                self.slots.release()
+
+    async def connect(self):
+        """Open the connection, put it in TLS mode and log in if needed.
+        The hosts are tried like :meth:`sender.Connection.connect` does.
+        """
+        hosts = self.mail.hosts
+        error = None
+        for endpoint in hosts.candidates():
+            try:
+                await self._connect(endpoint)
+            except (SMTPConnectError, SMTPServerDisconnected) as e:
+                error = e
+                hosts.mark_down(endpoint)
+                self.metrics.increment('connections.failed', 1, endpoint.host)
+            else:
+                hosts.mark_up(endpoint)
+                self.metrics.increment('connections.opened', 1, endpoint.host)
+                break
+        else:
+            if error is None:
+                raise SenderError('no SMTP server to connect to')
+            raise error
+
+        if self.mail.use_tls:
+            start = time.time()
+            await self.starttls()
+            self.metrics.timing('tls', time.time() - start, endpoint.host)
+
+        if self.mail.username and self.mail.password:
+            start = time.time()
+            await self.login(self.mail.username, self.mail.password)
+            self.metrics.timing('auth', time.time() - start, endpoint.host)
+
+    async def _connect(self, endpoint):
+        self.endpoint = endpoint
+        start = time.time()
+        context = ssl.create_default_context() if self.mail.use_ssl else None
+        try:
+            self.reader, self.writer = await asyncio.open_connection(
+                endpoint.host, endpoint.port, ssl=context)
+        except OSError as e:
+            raise SMTPConnectError(-1, str(e).encode('utf-8'))
+        code, resp = await self.getreply()
+        if code != 220:
+            self.close()
+            raise SMTPConnectError(code, resp)
+        self.metrics.timing('connect', time.time() - start, endpoint.host)
+        await self.ehlo()
+
+    @property
+    def local_hostname(self):
+        # an address literal, so that we never block on DNS lookups
+        return '[%s]' % self.writer.get_extra_info('sockname')[0]
+
+    def has_extn(self, opt):
+        return opt.lower() in self.esmtp_features
+
+    async def ehlo(self):
+        self.esmtp_features = {}
+        code, resp = await self.docmd('ehlo ' + self.local_hostname)
+        if code != 250:
+            code, resp = await self.docmd('helo ' + self.local_hostname)
+            if code != 250:
+                raise SMTPHeloError(code, resp)
+            return
+        for line in resp.decode('latin-1').split('\n')[1:]:
+            parts = line.split(None, 1)
+            if parts:
+                self.esmtp_features[parts[0].lower()] = \
+                    parts[1] if len(parts) > 1 else ''
+
+    async def starttls(self):
+        if not self.has_extn('starttls'):
+            raise SMTPNotSupportedError(
+                'STARTTLS extension not supported by server.')
+        code, resp = await self.docmd('STARTTLS')
+        if code != 220:
+            raise SMTPResponseException(code, resp)
+        context = ssl.create_default_context()
+        if hasattr(self.writer, 'start_tls'):
+            await self.writer.start_tls(context,
+                                        server_hostname=self.endpoint.host)
+        else:
+            loop = asyncio.get_event_loop()
+            protocol = self.writer.transport.get_protocol()
+            transport = await loop.start_tls(
+                self.writer.transport, protocol, context,
+                server_hostname=self.endpoint.host)
+            self.writer = asyncio.StreamWriter(transport, protocol,
+                                               self.reader, loop)
+        await self.ehlo()
+
+    async def login(self, username, password):
+        mechanisms = self.esmtp_features.get('auth', '').upper().split()
+        if 'PLAIN' in mechanisms:
+            token = '\0%s\0%s' % (username, password)
+            code, resp = await self.docmd(
+                'AUTH PLAIN ' + base64.b64encode(token.encode('utf-8'))
+                .decode('ascii'))
+        elif 'LOGIN' in mechanisms:
+            code, resp = await self.docmd('AUTH LOGIN')
+            for secret in (username, password):
+                if code != 334:
+                    break
+                code, resp = await self.docmd(
+                    base64.b64encode(secret.encode('utf-8')).decode('ascii'))
+        else:
+            raise SMTPException('No suitable authentication method found.')
+        if code not in (235, 503):
+            raise SMTPAuthenticationError(code, resp)
+
+    async def quit(self):
+        try:
+            await self.docmd('quit')
+        except (SMTPServerDisconnected, OSError):
+            pass
+        self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def getreply(self):
+        """Read one possibly multiline reply, returns (code, message).
+        """
+        lines = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                self.close()
+                raise SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip(b' \t\r\n'))
+            try:
+                code = int(line[:3])
+            except ValueError:
+                code = -1
+                break
+            if line[3:4] != b'-':
+                break
+        return code, b'\n'.join(lines)
+
+    async def docmd(self, cmd):
+        if self.writer is None:
+            raise SMTPServerDisconnected('please run connect() first')
+        self.writer.write(cmd.encode('utf-8') + b'\r\n')
+        await self.writer.drain()
+        return await self.getreply()
+
+    async def send(self, message):
+        """Send one message instance, returns one :class:`sender.SendResult`
+        just like :meth:`sender.Connection.send`.
+
+        :param message: one message instance.
+        """
+        limiter = self.mail.rate_limiter
+        if limiter is not None:
+            delay = limiter.reserve(len(message.to_addrs))
+            if delay > 0:
+                await asyncio.sleep(delay)
+        result = SendResult(message)
+        result.attempts = 1
+        start = time.time()
+        envelopes = split_recipients(message, self.mail.max_recipients)
+        try:
+            if len(envelopes) == 1:
+                await self._send_failover(result)
+            else:
+                for envelope in envelopes:
+                    sent = SendResult(envelope)
+                    try:
+                        await self._send_failover(sent)
+                    except SMTPRecipientsRefused as e:
+                        sent.refused = e.recipients
+                    except (SMTPException, OSError) as e:
+                        sent.refused = refused_by(e, envelope.to_addrs)
+                    result.merge(sent)
+                if not result.accepted:
+                    raise SMTPRecipientsRefused(result.refused)
+        except SMTPException as e:
+            if limiter is not None:
+                limiter.feedback(reply_codes(e))
+            self.metrics.increment('messages.failed', 1, self.endpoint.host)
+            raise
+        finally:
+            result.elapsed = time.time() - start
+        if limiter is not None:
+            limiter.feedback(result.codes)
+        self.metrics.record(result, self.endpoint.host)
+        return result
+
+    async def _send_failover(self, result):
+        # when the session breaks, send again through the other hosts
+        tries = len(self.mail.hosts)
+        while True:
+            try:
+                return await self._send(result)
+            except (SMTPException, OSError) as e:
+                tries -= 1
+                if tries <= 0 or not is_broken(e):
+                    raise
+                self.mail.hosts.mark_down(self.endpoint)
+                self.close()
+                await self.connect()
+
+    async def _send(self, result):
+        message = result.message
+        host = self.endpoint.host
+        mail_options = list(message.mail_options)
+        if message.has_streams:
+            chunks = message.iter_bytes()
+        else:
+            start = time.time()
+            chunks = [message.as_bytes()]
+            self.metrics.timing('render', time.time() - start, host)
+            if self.has_extn('size'):
+                mail_options.insert(0, 'size=%d' % len(chunks[0]))
+        start = time.time()
+        try:
+            await self._send_chunks(result, chunks, mail_options)
+        finally:
+            self.metrics.timing('transmit', time.time() - start, host)
+            self.metrics.increment('bytes', result.bytes_sent, host)
+
+    async def _send_chunks(self, result, chunks, mail_options):
+        message = result.message
+        to_addrs = list(message.to_addrs)
+        commands = envelope_commands(message.fromaddr, to_addrs,
+                                     mail_options, message.rcpt_options)
+
+        if self.has_extn('pipelining'):
+            self.writer.write(''.join(c + '\r\n' for c in commands)
+                              .encode('utf-8'))
+            await self.writer.drain()
+            replies = [await self.getreply() for c in commands]
+        else:
+            # one command after the other, stop as soon as the transaction
+            # fails
+            replies = []
+            for command in commands:
+                if command == 'data' and \
+                        not any(code in (250, 251) for code, _ in replies[1:]):
+                    break
+                replies.append(await self.docmd(command))
+                if replies[0][0] != 250:
+                    break
+            replies.extend([(-1, b'')] * (len(commands) - len(replies)))
+
+        refused, error = check_envelope(message.fromaddr, to_addrs, replies)
+        result.refused = refused
+        if error is None:
+            for chunk in quote_chunks(chunks):
+                self.writer.write(chunk)
+                result.bytes_sent += len(chunk)
+                await self.writer.drain()
+            result.reply = await self.getreply()
+            if result.reply[0] != 250:
+                error = SMTPDataError(*result.reply)
+        elif replies[-1][0] == 354:
+            # the server wants data we are not going to send
+            self.writer.write(b'.\r\n')
+            await self.getreply()
+        if error is not None:
+            if getattr(error, 'smtp_code', None) == 421:
+                self.close()
+            else:
+                try:
+                    await self.docmd('rset')
+                except (SMTPServerDisconnected, OSError):
+                    pass
+            raise error
+        result.accepted = [addr for addr in to_addrs if addr not in refused]
+
+
+async def open_connection_slot(limiter):
+    """Wait without blocking the event loop until one connection slot of
+    one :class:`sender.RateLimiter` is free, and take it.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        waiter = loop.create_future()
+
+        def wake(waiter=waiter):
+            loop.call_soon_threadsafe(
+                lambda: waiter.done() or waiter.set_result(None))
+
+        if limiter.try_open_connection(wake):
+            return
+        await waiter
@@ -30,9 +30,17 @@ Links
   <http://github.com/fengsp/sender/zipball/master#egg=sender-dev>`_
 
 """
+import sys
+
 from setuptools import setup
 
 
+# the asyncio client is written with async/await
+py_modules = ['sender']
+if sys.version_info >= (3, 5):
+    py_modules.append('sender_async')
+
+
 setup(
     name='sender',
     version='0.3',
@@ -42,17 +50,17 @@ setup(
     author_email='fsp261@gmail.com',
     description='Python SMTP Client for Humans',
     long_description=__doc__,
-    py_modules= ['sender',],
+    py_modules=py_modules,
     zip_safe=False,
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.6',
         'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
         'Programming Language :: Python :: 3.3',
         'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.5',
     ],
 )
@@ -9,11 +9,25 @@
     :copyright: (c) 2016 by Shipeng Feng.
     :license: BSD, see LICENSE for more details.
 """
+import re
 import sys
+import socket
+import smtplib
+import threading
 import unittest
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
 
-from sender import Mail, Message, Attachment
-from sender import SenderError
+from sender import Mail, Message, Attachment, MessageTemplate, MessageBatch
+from sender import SenderError, RetryPolicy, RateLimiter, TokenBucket, \
+    HostList, Metrics, StatsdMetrics, Spool
+try:
+    import asyncio
+    from sender_async import AsyncMail
+except (ImportError, SyntaxError):
+    AsyncMail = None
 
 
 class BaseTestCase(unittest.TestCase):
@@ -55,6 +69,11 @@ class BaseTestCase(unittest.TestCase):
     def assert_isinstance(self, obj, cls):
         self.assertIsInstance(obj, cls)
 
+    def assert_same_mime(self, first, second):
+        # multipart boundaries are random on every render
+        boundary = re.compile(br'===============\d+==')
+        self.assert_equal(boundary.sub(b'', first), boundary.sub(b'', second))
+
     if sys.version_info[:2] == (2, 6):
         def assertIn(self, x, y):
             assert x in y, "%r not found in %r" % (x, y)
@@ -66,6 +85,153 @@ class BaseTestCase(unittest.TestCase):
             assert isinstance(x, y), "not isinstance(%r, %r)" % (x, y)
 
 
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """A tiny SMTP server session that accepts everything, except
+    recipients whose local part starts with ``refused`` (550) or
+    ``deferred`` (451).  Replies queued in ``server.script`` for one verb
+    are given first, one per command, 421 also ends the session and an
+    empty one drops the connection without a reply.
+    """
+    disable_nagle_algorithm = True
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.sessions += 1
+            server.active += 1
+            busy = server.max_sessions is not None and \
+                server.active > server.max_sessions
+        try:
+            if busy:
+                self.reply('421 too many sessions')
+            else:
+                self.session()
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def session(self):
+        server = self.server
+        self.reply('220 localhost test server')
+        mailfrom, rcpts = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            line = line.decode('utf-8').rstrip('\r\n')
+            server.commands.append(line)
+            verb = line.split(' ', 1)[0].upper()
+            with server.lock:
+                scripted = server.script.get(verb)
+                scripted = scripted.pop(0) if scripted else None
+            if scripted == '':
+                break
+            if scripted is not None:
+                self.reply(scripted)
+                if scripted.startswith('421'):
+                    break
+                continue
+            if verb == 'EHLO':
+                extensions = ['localhost'] + server.extensions
+                for extension in extensions[:-1]:
+                    self.reply('250-' + extension)
+                self.reply('250 ' + extensions[-1])
+            elif verb == 'HELO':
+                self.reply('250 localhost')
+            elif verb == 'AUTH':
+                self.reply('235 ok')
+            elif verb == 'MAIL':
+                mailfrom, rcpts = line[10:].split(' ')[0].strip('<>'), []
+                self.reply('250 ok')
+            elif verb == 'RCPT':
+                rcpt = line[8:].split(' ')[0].strip('<>')
+                if rcpt.startswith('refused'):
+                    self.reply('550 no such user')
+                elif rcpt.startswith('deferred'):
+                    self.reply('451 try again later')
+                else:
+                    rcpts.append(rcpt)
+                    self.reply('250 ok')
+            elif verb == 'DATA':
+                if not rcpts:
+                    self.reply('554 no valid recipients')
+                    continue
+                self.reply('354 go ahead')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if line in (b'.\r\n', b''):
+                        break
+                    data.append(line)
+                server.messages.append((mailfrom, rcpts, b''.join(data)))
+                self.reply('250 queued')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 ok')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                break
+            else:
+                self.reply('502 not implemented')
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 SMTPHandler)
+        self.extensions = ['PIPELINING', 'SIZE 10240000', '8BITMIME',
+                           'AUTH PLAIN LOGIN']
+        self.lock = threading.Lock()
+        self.max_sessions = None
+        self.sessions = 0
+        self.active = 0
+        self.commands = []
+        self.messages = []
+        self.script = {}
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class ServerTestCase(BaseTestCase):
+    """Baseclass for the tests that talk to a local SMTP server.
+    """
+
+    def setUp(self):
+        self.server = SMTPServer()
+        self.server.start()
+        self.mails = []
+        BaseTestCase.setUp(self)
+
+    def tearDown(self):
+        BaseTestCase.tearDown(self)
+        for mail in self.mails:
+            mail.close()
+        self.server.stop()
+
+    def make_mail(self, **kwargs):
+        kwargs.setdefault('fromaddr', 'from@example.com')
+        mail = Mail('127.0.0.1', port=self.server.port, **kwargs)
+        self.mails.append(mail)
+        return mail
+
+
 class MailTestCase(BaseTestCase):
 
     def test_global_fromaddr(self):
@@ -119,6 +285,39 @@ class MessageTestCase(BaseTestCase):
         self.assert_in('to@example.com', str(msg))
         self.assert_in('reply-to@example.com', str(msg))
 
+    def test_address_cache(self):
+        from sender import address_cache, process_address
+        address_cache.clear()
+        first = process_address(u'Tom <tom@example.com>')
+        self.assert_equal(address_cache.info()['misses'], 1)
+        self.assert_true(process_address(u'Tom <tom@example.com>') is first)
+        self.assert_equal(address_cache.info()['hits'], 1)
+        process_address(u'Tom <tom@example.com>', 'ascii')
+        self.assert_equal(address_cache.info()['misses'], 2)
+
+    def test_lru_cache(self):
+        from sender import LRUCache
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assert_equal(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assert_equal(cache.get('b'), None)
+        self.assert_equal(cache.get('a'), 1)
+        self.assert_equal(cache.info(), {'hits': 2, 'misses': 1,
+                                         'hit_rate': 2 / 3.0,
+                                         'size': 2, 'maxsize': 2})
+        cache = LRUCache(maxbytes=10)
+        cache.set('a', b'12345')
+        cache.set('b', b'1234')
+        cache.set('c', b'12345678901')
+        self.assert_equal(cache.get('c'), None)
+        cache.set('c', b'12')
+        self.assert_equal(cache.get('a'), None)
+        self.assert_equal(cache.get('b'), b'1234')
+        self.assert_equal(cache.bytes, 6)
+        self.assert_equal(cache.info()['hit_rate'], 1 / 3.0)
+
     def test_charset(self):
         msg = Message()
         self.assert_equal(msg.charset, 'utf-8')
@@ -202,6 +401,26 @@ class MessageTestCase(BaseTestCase):
         msg = Message(fromaddr='from@example.com', to='to@example.com')
         self.assert_in('Message-ID: %s' % msg.message_id, str(msg))
 
+    def test_lazy_message_id(self):
+        from sender import MessageIDGenerator
+        msg = Message(fromaddr='from@example.com', to='to@example.com')
+        self.assert_equal(msg._message_id, None)
+        message_id = msg.message_id
+        self.assert_equal(msg.message_id, message_id)
+        msg.message_id = '<custom@example.com>'
+        self.assert_in('Message-ID: <custom@example.com>', str(msg))
+        generate = MessageIDGenerator('example.org')
+        ids = set(generate() for i in range(100))
+        self.assert_equal(len(ids), 100)
+        for message_id in ids:
+            self.assert_true(message_id.endswith('@example.org>'))
+
+    def test_mail_message_id_domain(self):
+        mail = Mail(message_id_domain='mail.example.com')
+        msg = Message(fromaddr='from@example.com', to='to@example.com')
+        mail.prepare(msg)
+        self.assert_true(msg.message_id.endswith('@mail.example.com>'))
+
     def test_attachment_ascii_filename(self):
         msg = Message(fromaddr='from@example.com', to='to@example.com')
         msg.attach_attachment('my test doc.txt', 'text/plain', b'this is test')
@@ -216,6 +435,43 @@ class MessageTestCase(BaseTestCase):
         self.assert_in('UTF8\'\'%E6%88%91%E7%9A%84%E6%B5%8B%E8%AF'
                        '%95%E6%96%87%E6%A1%A3.txt', str(msg))
 
+    def test_render_cache(self):
+        msg = Message('hello', fromaddr='from@example.com',
+                      to='to@example.com', body='hello world')
+        self.assert_true(msg.as_string() is msg.as_string())
+        self.assert_true(msg.as_bytes() is msg.as_bytes())
+        msg.subject = 'changed'
+        self.assert_in('changed', msg.as_string())
+        msg.to = 'other@example.com'
+        self.assert_in('other@example.com', msg.as_string())
+        msg.attach_attachment('test.txt', 'text/plain', b'this is test')
+        self.assert_in('test.txt', msg.as_string())
+        msg.extra_headers = {}
+        msg.extra_headers['Extra-Header-Test'] = 'Test'
+        self.assert_in('Extra-Header-Test: Test', msg.as_bytes().decode())
+
+    def test_as_bytes(self):
+        body = u'gr\xfc\xdfe aus K\xf6ln'
+        msg = Message('hello', fromaddr='from@example.com',
+                      to='to@example.com', body=body)
+        self.assert_in(body.encode('utf-8'), msg.as_bytes())
+        if sys.version_info[0] == 2:
+            # as_string is bytes already, and there are no buffer
+            # attachments on Python 2, see Attachment.is_buffer
+            self.assert_equal(msg.as_string(), msg.as_bytes())
+            return
+        self.assert_equal(msg.as_string(), msg.as_bytes().decode('utf-8'))
+        # the payload of buffer attachments is not run through the email
+        # generator, it is joined to the rest afterwards
+        data = b'this is test' * 1000
+        msg.attach_attachment('test.txt', 'text/plain', data)
+        attachment = msg.attachments[0]
+        skeleton = msg._skeleton()
+        self.assert_true(attachment in skeleton)
+        self.assert_true(sum(len(item) for item in skeleton
+                             if item is not attachment) < 2000)
+        self.assert_in(attachment.encoded(), msg.as_bytes())
+
 
 class AttachmentTestCase(BaseTestCase):
 
@@ -223,11 +479,1588 @@ class AttachmentTestCase(BaseTestCase):
         attach = Attachment()
         self.assert_equal(attach.disposition, 'attachment')
 
+    def test_stream(self):
+        import io
+        import os
+        import tempfile
+        data = os.urandom(200000)
+        f = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            f.write(data)
+            f.close()
+            for attachment in (Attachment('data.bin', 'application/bin',
+                                          path=f.name),
+                               Attachment('data.bin', 'application/bin',
+                                          io.BytesIO(data))):
+                self.assert_true(attachment.is_stream)
+                self.assert_equal(attachment.read(), data)
+                self.assert_equal(attachment.read(), data)
+                msg = Message('hello', fromaddr='from@example.com',
+                              to='to@example.com', body='hello')
+                msg.attach(attachment)
+                chunks = list(msg.iter_bytes())
+                self.assert_true(max(map(len, chunks)) < 80000)
+                self.assert_same_mime(b''.join(chunks), msg.as_bytes())
+                if sys.version_info[0] == 2:
+                    # the email package of Python 2 drops the line break
+                    # after one base64 payload, streams keep it
+                    continue
+                msg.attachments[0] = Attachment('data.bin',
+                                                'application/bin', data)
+                self.assert_same_mime(b''.join(chunks), msg.as_bytes())
+        finally:
+            os.remove(f.name)
+
+    @unittest.skipIf(sys.version_info[0] == 2,
+                     'buffer attachments need Python 3')
+    def test_buffer(self):
+        import mmap
+        data = b'this is test' * 1000
+        expected = Message(fromaddr='from@example.com', to='to@example.com',
+                           date=1000000000)
+        expected.attach_attachment('test.txt', 'text/plain', data)
+        m = mmap.mmap(-1, len(data))
+        m.write(data)
+        view = memoryview(data)
+        for buf in (bytearray(data), view, m):
+            attachment = Attachment('test.txt', 'text/plain', buf)
+            self.assert_true(attachment.is_buffer)
+            self.assert_false(attachment.is_stream)
+            msg = Message(fromaddr='from@example.com', to='to@example.com',
+                          date=expected.date)
+            msg.message_id = expected.message_id
+            msg.attach(attachment)
+            self.assert_same_mime(msg.as_bytes(), expected.as_bytes())
+        # the encoding of one buffer is shared
+        first = Attachment('a.txt', 'text/plain', view)
+        second = Attachment('b.txt', 'text/plain', view)
+        self.assert_true(first.encoded() is second.encoded())
+        m.close()
+
+    def test_encoding_cache(self):
+        from sender import encoding_cache
+        if sys.version_info[0] == 2:
+            return
+        encoding_cache.clear()
+        logo = b'\x89PNG' * 1000
+        first = Attachment('logo.png', 'image/png', logo)
+        second = Attachment('logo.png', 'image/png', bytes(bytearray(logo)))
+        self.assert_true(first.encoded() is second.encoded())
+        info = encoding_cache.info()
+        self.assert_equal((info['hits'], info['misses']), (1, 1))
+        self.assert_equal(info['bytes'], len(first.encoded()))
+        self.assert_equal(encoding_cache.hit_rate, 0.5)
+        other = Attachment('logo.bin', 'application/octet-stream', logo)
+        self.assert_equal(other.encoded(), first.encoded())
+        self.assert_equal(encoding_cache.info()['size'], 2)
+
+    def test_quote_chunks(self):
+        from sender import quote_data, quote_chunks
+        data = b'.one\n..two\r\nthree\r.four\nfive'
+        for size in range(1, len(data)):
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            self.assert_equal(b''.join(quote_chunks(chunks)),
+                              quote_data(data))
+
     def test_headers(self):
         attach = Attachment()
         self.assert_equal(attach.headers, {})
 
 
+class FastRenderTestCase(BaseTestCase):
+
+    def render(self, msg, renderer):
+        import random
+        msg.date = 1000000000
+        msg.message_id = '<test@example.com>'
+        msg._renderer = renderer
+        # both renderers draw the same boundaries from the same seed
+        random.seed(42)
+        return msg.as_bytes()
+
+    def assert_same_render(self, msg):
+        from sender import fast_render
+        expected = self.render(msg, 'email')
+        self.assert_equal(self.render(msg, 'fast'), expected)
+        if sys.version_info[0] > 2:
+            self.assert_true(fast_render(msg) is not None)
+            self.assert_equal(msg.as_string(),
+                              expected.decode('utf-8', 'surrogateescape'))
+
+    def test_plain_text(self):
+        self.assert_same_render(Message('hello', to='to@example.com',
+                                        body='hello\r\nworld\rnow\n',
+                                        fromaddr='from@example.com'))
+        self.assert_same_render(Message(to='to@example.com', body=None,
+                                        fromaddr='from@example.com',
+                                        charset='us-ascii'))
+
+    def test_headers(self):
+        self.assert_same_render(Message(
+            u'Hall\xf6 ' * 30, body='hello',
+            to=['to@example.com', u'J\xf6rg <j@example.com>'],
+            fromaddr=(u'Fr\xf6m', 'from@example.com'),
+            cc='cc@example.com', reply_to='reply-to@example.com',
+            extra_headers={'X-Plain': 'one', 'X-Unicode': u'\xf6',
+                           'X-Lines': 'one\ntwo', 'X-Long': 'word ' * 50}))
+
+    def test_html(self):
+        self.assert_same_render(Message(
+            'hello', to='to@example.com', body=u'gr\xfc\xdfe',
+            html=u'<p>\xfc</p>', fromaddr='from@example.com'))
+        self.assert_same_render(Message(
+            'hello', to='to@example.com', html='<p>hello</p>',
+            fromaddr='from@example.com'))
+
+    def test_body_encodings(self):
+        # quoted-printable and base64
+        for charset, text in (('iso-8859-1', u'caf\xe9 '),
+                              ('koi8-r', u'\u0436\u0443\u043a ')):
+            self.assert_same_render(Message(
+                'hello', to='to@example.com', body=text * 40,
+                html=u'<p>%s</p>' % text, fromaddr='from@example.com',
+                charset=charset))
+
+    def test_charset_aliases(self):
+        from sender import fast_render
+        for charset in ('UTF-8', 'latin-1', 'ISO-8859-1', 'ascii'):
+            msg = Message('hello', to='to@example.com', body='hello',
+                          fromaddr='from@example.com', charset=charset)
+            self.assert_equal(self.render(msg, 'fast'),
+                              self.render(msg, 'email'))
+            self.assert_true(fast_render(msg) is None)
+
+    def test_iso_2022_jp(self):
+        for text in (u'hello', u'\u3053\u3093\u306b\u3061\u306f'):
+            msg = Message('hello', to='to@example.com', body=text, html=text,
+                          fromaddr='from@example.com', charset='iso-2022-jp')
+            self.assert_same_render(msg)
+            if sys.version_info[0] > 2:
+                # the escape sequences stay as they are on the wire
+                self.assert_in(text.encode('iso-2022-jp').decode('ascii'),
+                               msg.as_string())
+
+    def test_attachments(self):
+        import io
+        msg = Message('hello', to='to@example.com', body='hello',
+                      fromaddr='from@example.com')
+        msg.attach(Attachment(u'\u6d4b\u8bd5.txt', 'text/plain', b'test'))
+        msg.attach(Attachment('a"b.bin', 'application/octet-stream',
+                              bytearray(range(256)) * 40,
+                              headers={'Content-ID': '<logo>'}))
+        msg.attach(Attachment('empty.bin', 'application/octet-stream',
+                              b'', disposition='inline'))
+        msg.attach(Attachment('stream.bin', 'application/octet-stream',
+                              io.BytesIO(b'streamed')))
+        self.assert_same_render(msg)
+
+    def test_boundary_in_body(self):
+        import random
+        random.seed(42)
+        boundary = '=' * 15 + '%0*d' % (len(repr(sys.maxsize - 1)),
+                                         random.randrange(sys.maxsize)) + '=='
+        msg = Message('hello', to='to@example.com', html='html',
+                      body='--%s\n--%s--' % (boundary, boundary),
+                      fromaddr='from@example.com')
+        self.assert_same_render(msg)
+        self.assert_in(('boundary="%s.0"' % boundary).encode('ascii'),
+                       msg.as_bytes())
+
+    def test_fallback(self):
+        from sender import fast_render
+        msg = Message('hello', to='to@example.com', body='hello',
+                      fromaddr='from@example.com', charset='euc-jp')
+        self.assert_true(fast_render(msg) is None)
+        self.assert_equal(self.render(msg, 'fast'),
+                          self.render(msg, 'email'))
+
+    def test_mail_renderer(self):
+        mail = Mail(renderer='fast')
+        msg = Message('hello', to='to@example.com', body='hello',
+                      fromaddr='from@example.com')
+        mail.prepare(msg)
+        self.assert_equal(msg._renderer, 'fast')
+        self.assert_raises(SenderError, Mail, renderer='mime')
+
+
+class FailingConnection(object):
+    """Fails like one server refusing the session, or dropping it while one
+    message is sent.
+    """
+
+    def __init__(self, error, on_send=False):
+        self.error = error
+        self.on_send = on_send
+
+    def __enter__(self):
+        if not self.on_send:
+            raise self.error
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        pass
+
+    def send(self, message):
+        raise self.error
+
+
+class FailingMail(Mail):
+    """Its first ``failures`` connections fail with ``error``."""
+
+    failures = 0
+    error = smtplib.SMTPConnectError(421, b'too many sessions')
+    on_send = False
+    _lock = threading.Lock()
+
+    @property
+    def connection(self):
+        with self._lock:
+            self.failures -= 1
+            if self.failures >= 0:
+                return FailingConnection(self.error, self.on_send)
+        return Mail.connection.fget(self)
+
+
+class ParallelSendTestCase(ServerTestCase):
+
+    def test_results(self):
+        mail = self.make_mail()
+        result = mail.send_message('hello', to='to@example.com')
+        self.assert_equal(result.refused, {})
+        self.assert_equal(result.accepted, ['to@example.com'])
+        msg = Message('hello', to=['to@example.com', 'refused@example.com'])
+        [result] = mail.send([msg])
+        self.assert_true(result.message is msg)
+        self.assert_equal(result.accepted, ['to@example.com'])
+        self.assert_equal(result.refused,
+                          {'refused@example.com': (550, b'no such user')})
+        self.assert_equal(result.reply, (250, b'queued'))
+        self.assert_equal(result.attempts, 1)
+        self.assert_true(result.elapsed > 0)
+        self.assert_equal(result.bytes_sent,
+                          len(self.server.messages[-1][2]) + 3)
+
+    def test_concurrency(self):
+        mail = self.make_mail()
+        messages = [Message('hello', to=['to%d@example.com' % i,
+                                         'refused%d@example.com' % i])
+                    for i in range(20)]
+        results = mail.send(messages, concurrency=4)
+        self.assert_equal(len(self.server.messages), 20)
+        self.assert_true(self.server.sessions <= 4)
+        for i, result in enumerate(results):
+            self.assert_equal(list(result.refused),
+                              ['refused%d@example.com' % i])
+
+    def test_shared_stream(self):
+        import io
+        import os
+        import email
+        data = os.urandom(500000)
+        shared = io.BytesIO(data)
+        messages = []
+        for i in range(8):
+            msg = Message('hello', to='to%d@example.com' % i)
+            msg.attach(Attachment('data.bin', 'application/bin', shared))
+            messages.append(msg)
+        mail = self.make_mail()
+        mail.send(messages, concurrency=4)
+        msg = Message('hello', to=['to%d@example.com' % i for i in range(8)])
+        msg.attach(Attachment('data.bin', 'application/bin', shared))
+        self.make_mail(max_recipients=1).send(msg, concurrency=4)
+        self.assert_equal(len(self.server.messages), 16)
+        parse = getattr(email, 'message_from_bytes', email.message_from_string)
+        for _, _, raw in self.server.messages:
+            part = parse(raw).get_payload()[-1]
+            self.assert_equal(part.get_payload(decode=True), data)
+
+    def test_max_connections(self):
+        mail = self.make_mail(max_connections=2)
+        messages = [Message('hello', to='to@example.com') for i in range(10)]
+        mail.send(messages, concurrency=8)
+        self.assert_equal(len(self.server.messages), 10)
+        self.assert_true(self.server.sessions <= 2)
+
+    def test_server_session_limit(self):
+        self.server.max_sessions = 1
+        mail = self.make_mail()
+        messages = [Message('hello', to='to@example.com') for i in range(10)]
+        results = mail.send(messages, concurrency=4)
+        self.assert_equal([r.message for r in results], messages)
+        self.assert_equal(len(self.server.messages), 10)
+
+    def test_connect_refused(self):
+        mail = FailingMail('127.0.0.1', port=self.server.port,
+                           fromaddr='from@example.com')
+        mail.failures = 4
+        messages = [Message('hello', to='to%d@example.com' % i)
+                    for i in range(6)]
+        results = mail.send(messages, concurrency=4)
+        self.assert_equal([r.message for r in results], messages)
+        self.assert_equal(len(self.server.messages), 6)
+        self.assert_equal(self.server.sessions, 1)
+
+    def test_error(self):
+        import smtplib
+        mail = self.make_mail()
+        messages = [Message('hello', to='to@example.com') for i in range(5)]
+        messages.append(Message('hello', to='refused@example.com'))
+        self.assert_raises(smtplib.SMTPRecipientsRefused, mail.send,
+                           messages, concurrency=2)
+
+
+class PipeliningTestCase(ServerTestCase):
+
+    def send(self, msg):
+        mail = self.make_mail()
+        writes = []
+        with mail.connection as c:
+            send = c.server.send
+            c.server.send = lambda s: (writes.append(s), send(s))
+            c.server.sendmail = None
+            result = c.send(msg)
+        return result, writes
+
+    def test_pipelining(self):
+        msg = Message('hello', fromaddr='from@example.com',
+                      to=['to01@example.com', 'to02@example.com'],
+                      cc='refused@example.com', body='hello\n.period')
+        result, writes = self.send(msg)
+        self.assert_equal(list(result.refused), ['refused@example.com'])
+        # ehlo, envelope, data and quit
+        self.assert_equal(len(writes), 4)
+        self.assert_equal(writes[1].count('\r\n'), 5)
+        mailfrom, rcpts, data = self.server.messages[0]
+        self.assert_equal(sorted(rcpts), ['to01@example.com',
+                                          'to02@example.com'])
+        self.assert_in(b'\r\n..period\r\n', data)
+        self.assert_in('size=', self.server.commands[1])
+
+    def test_all_refused(self):
+        import smtplib
+        msg = Message('hello', fromaddr='from@example.com',
+                      to=['refused01@example.com', 'refused02@example.com'])
+        self.assert_raises(smtplib.SMTPRecipientsRefused, self.send, msg)
+        self.assert_equal(self.server.messages, [])
+        self.assert_equal(self.server.commands[-2], 'rset')
+
+    def test_stream(self):
+        import io
+        data = b'x' * 100000
+        for extensions in (['PIPELINING'], []):
+            self.server.extensions = extensions
+            self.server.messages = []
+            msg = Message('hello', fromaddr='from@example.com',
+                          to='to@example.com', body='hello')
+            msg.attach(Attachment('data.bin', 'application/bin',
+                                  io.BytesIO(data)))
+            result, writes = self.send(msg)
+            self.assert_equal(result.accepted, ['to@example.com'])
+            received = self.server.messages[0][2]
+            self.assert_same_mime(received.replace(b'\r\n', b'\n'),
+                                  msg.as_bytes())
+
+    def test_fallback(self):
+        self.server.extensions = ['SIZE 10240000']
+        mail = self.make_mail()
+        result = mail.send_message('hello', to=['to@example.com',
+                                                'refused@example.com'])
+        self.assert_equal(list(result.refused), ['refused@example.com'])
+        self.assert_equal(result.reply, (250, b'queued'))
+        self.assert_equal(len(self.server.messages), 1)
+
+
+class MessageTemplateTestCase(ServerTestCase):
+
+    def make_template(self, **kwargs):
+        template = MessageTemplate('Hello $name', body='Dear $name',
+                                   html='<b>hello</b>', **kwargs)
+        template.attachments.append(Attachment('test.txt', 'text/plain',
+                                               b'this is test'))
+        return template
+
+    def test_render(self):
+        template = self.make_template(fromaddr='from@example.com')
+        msg = template.render({'to': 'to@example.com', 'name': 'Tom'})
+        self.assert_equal(msg.to, set(['to@example.com']))
+        self.assert_equal(msg.subject, 'Hello Tom')
+        self.assert_equal(msg.body, 'Dear Tom')
+        self.assert_in('test.txt', str(msg))
+        self.assert_raises(KeyError, template.render, {'to': 'to@example.com'})
+
+    def test_shared_parts(self):
+        template = self.make_template()
+        self.assert_equal(len(template.shared_parts), 1)
+        template = MessageTemplate('Hello $name', body='hello',
+                                   html='<b>hello</b>')
+        self.assert_equal(list(template.shared_parts), ['alternative'])
+        template = MessageTemplate('hello', body='hello', html='<b>$name</b>')
+        self.assert_equal(template.shared_parts, {})
+
+    def test_send_merge(self):
+        import sender
+        encoded = []
+        # the email package encodes attachments on Python 2
+        name = 'encode_base64' if sys.version_info[0] == 2 else 'encodebytes'
+        encode = getattr(sender, name)
+
+        def counting_encode(data):
+            encoded.append(data)
+            return encode(data)
+
+        setattr(sender, name, counting_encode)
+        sender.encoding_cache.clear()
+        try:
+            mail = self.make_mail()
+            rows = [{'to': 'to%d@example.com' % i, 'name': 'name%d' % i}
+                    for i in range(5)]
+            results = mail.send_merge(self.make_template(), rows)
+        finally:
+            setattr(sender, name, encode)
+        self.assert_equal([r.refused for r in results], [{}] * 5)
+        self.assert_equal(len(encoded), 1)
+        for i, (_, rcpts, data) in enumerate(self.server.messages):
+            self.assert_equal(rcpts, ['to%d@example.com' % i])
+            self.assert_in(('Dear name%d' % i).encode('ascii'), data)
+            self.assert_in(b'dGhpcyBpcyB0ZXN0', data)
+
+
+class MessageBatchTestCase(ServerTestCase):
+
+    def test_batch(self):
+        msg = Message('hello $name', fromaddr=(u'发件人', 'from@example.com'),
+                      cc='cc@example.com', body='hello', html='<b>hi</b>')
+        msg.attach_attachment('test.txt', 'text/plain', b'this is test')
+        batch = MessageBatch(msg, ['to%d@example.com' % i for i in range(3)])
+        batch.append('last@example.com')
+        self.assert_equal(len(batch), 4)
+        messages = list(batch)
+        self.assert_equal(messages[0].to, set(['to0@example.com']))
+        self.assert_equal(messages[3].to, set(['last@example.com']))
+        self.assert_equal(messages[0].fromaddr, msg.fromaddr)
+        self.assert_equal(messages[0].cc, msg.cc)
+        self.assert_equal(messages[0].subject, 'hello $name')
+        self.assert_in(msg.fromaddr, str(messages[0]))
+
+    def test_send(self):
+        mail = self.make_mail()
+        msg = Message('hello', body='hello')
+        batch = MessageBatch(msg, ['to%d@example.com' % i for i in range(5)])
+        self.assert_equal([r.refused for r in mail.send(batch)], [{}] * 5)
+        self.assert_equal([m[1] for m in self.server.messages],
+                          [['to%d@example.com' % i] for i in range(5)])
+
+
+class RecipientChunkTestCase(ServerTestCase):
+
+    def make_message(self, count):
+        return Message('hello', to=['to%02d@example.com' % i
+                                    for i in range(count)], body='hello')
+
+    def test_split(self):
+        mail = self.make_mail(max_recipients=4)
+        msg = self.make_message(10)
+        result = mail.send(msg)
+        self.assert_equal(sorted(result.accepted), sorted(msg.to_addrs))
+        self.assert_equal(len(self.server.messages), 3)
+        self.assert_equal(sorted(len(m[1]) for m in self.server.messages),
+                          [2, 4, 4])
+        self.assert_equal(self.server.sessions, 1)
+        self.assert_equal(len(set(m[2] for m in self.server.messages)), 1)
+        self.assert_equal(result.bytes_sent,
+                          3 * (len(self.server.messages[0][2]) + 3))
+
+    def test_no_split(self):
+        mail = self.make_mail(max_recipients=10)
+        mail.send(self.make_message(10))
+        self.assert_equal(len(self.server.messages), 1)
+
+    def test_refused_chunk(self):
+        mail = self.make_mail(max_recipients=2)
+        msg = self.make_message(2)
+        msg.cc = ['refused%d@example.com' % i for i in range(4)]
+        result = mail.send(msg)
+        self.assert_equal(sorted(result.accepted),
+                          ['to00@example.com', 'to01@example.com'])
+        self.assert_equal(len(result.refused), 4)
+        msg = Message('hello', to=['refused%d@example.com' % i
+                                   for i in range(4)])
+        self.assert_raises(smtplib.SMTPRecipientsRefused, mail.send, msg)
+
+    def test_failed_chunk(self):
+        self.server.script['DATA'] = [None, '451 busy']
+        mail = self.make_mail(max_recipients=2, retry=RetryPolicy(
+            max_attempts=3, base_delay=0.01))
+        msg = self.make_message(4)
+        result = mail.send([msg])[0]
+        self.assert_true(result.ok)
+        self.assert_equal(result.attempts, 2)
+        self.assert_equal(sorted(result.accepted), sorted(msg.to_addrs))
+        # every recipient got the message once
+        self.assert_equal(len(self.server.messages), 2)
+        self.assert_equal(sorted(sum([m[1] for m in self.server.messages],
+                                     [])), sorted(msg.to_addrs))
+        self.server.script['DATA'] = [None, '554 rejected']
+        result = self.make_mail(max_recipients=2).send(msg)
+        self.assert_equal(len(result.accepted), 2)
+        self.assert_equal(list(result.refused.values()),
+                          [(554, b'rejected')] * 2)
+
+    def test_parallel(self):
+        mail = self.make_mail(max_recipients=5)
+        messages = [self.make_message(20), self.make_message(3)]
+        results = mail.send(messages, concurrency=4)
+        self.assert_equal([r.message for r in results], messages)
+        self.assert_equal([len(r.accepted) for r in results], [20, 3])
+        self.assert_equal(len(self.server.messages), 5)
+
+    @unittest.skipIf(AsyncMail is None, 'asyncio is not available')
+    def test_async(self):
+        mail = AsyncMail('127.0.0.1', port=self.server.port,
+                         fromaddr='from@example.com', max_recipients=4)
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(
+                mail.send(self.make_message(10)))
+        finally:
+            loop.close()
+        self.assert_equal(len(result.accepted), 10)
+        self.assert_equal(len(self.server.messages), 3)
+
+
+class DirectDeliveryTestCase(ServerTestCase):
+
+    def setup(self):
+        self.lookups = []
+
+    def resolver(self, domain):
+        self.lookups.append(domain)
+        if domain == 'down.example':
+            # nothing listens there
+            return [(10, '127.0.0.2')]
+        if domain == 'nx.example':
+            raise SenderError('domain nx.example does not exist')
+        if domain == 'broken.example':
+            raise ValueError('broken resolver')
+        return [(10, '127.0.0.1')]
+
+    def make_mail(self, **kwargs):
+        return ServerTestCase.make_mail(self, direct=True,
+                                        mx_resolver=self.resolver, **kwargs)
+
+    def test_group_by_domain(self):
+        from sender import group_by_domain
+        self.assert_equal(
+            list(group_by_domain(['b@Y.example', 'a@x.example',
+                                  'c@y.example']).items()),
+            [('x.example', ['a@x.example']),
+             ('y.example', ['b@Y.example', 'c@y.example'])])
+        self.assert_equal(
+            list(group_by_domain(['Foo <foo@a.example>', 'bar@a.example',
+                                  '"x@y" <baz@b.example>']).items()),
+            [('b.example', ['"x@y" <baz@b.example>']),
+             ('a.example', ['Foo <foo@a.example>', 'bar@a.example'])])
+
+    def test_display_names(self):
+        mail = self.make_mail()
+        result = mail.send(Message('hello', to=['Foo <foo@a.example>',
+                                                'bar@a.example']))
+        self.assert_true(result.ok)
+        self.assert_equal(self.lookups, ['a.example'])
+        self.assert_equal(len(self.server.messages), 1)
+
+    def test_direct(self):
+        mail = self.make_mail()
+        messages = [Message('hello', to=['a1@a.example', 'b1@b.example',
+                                         'a2@a.example']),
+                    Message('hello', to='b2@b.example')]
+        results = mail.send(messages, concurrency=1)
+        self.assert_equal([sorted(r.accepted) for r in results],
+                          [['a1@a.example', 'a2@a.example', 'b1@b.example'],
+                           ['b2@b.example']])
+        self.assert_equal(sorted(m[1] for m in self.server.messages),
+                          [['a1@a.example', 'a2@a.example'],
+                           ['b1@b.example'], ['b2@b.example']])
+        # both domains share one MX server, so one session
+        self.assert_equal(self.server.sessions, 1)
+        self.assert_equal(sorted(self.lookups), ['a.example', 'b.example'])
+        mail.send(messages)
+        self.assert_equal(sorted(self.lookups), ['a.example', 'b.example'])
+
+    def test_parallel(self):
+        mail = self.make_mail()
+        msg = Message('hello', to=['to@d%d.example' % i for i in range(20)])
+        result = mail.send(msg)
+        self.assert_equal(len(result.accepted), 20)
+        self.assert_equal(len(self.server.messages), 20)
+        self.assert_true(self.server.sessions <= 10)
+        data = set(m[2] for m in self.server.messages)
+        self.assert_equal(len(data), 1)
+
+    def test_failed_domain(self):
+        mail = self.make_mail(host_cooldown=0)
+        result = mail.send(Message('hello', to=['a@a.example',
+                                                'x@down.example',
+                                                'refused@a.example']))
+        self.assert_true(result.ok)
+        self.assert_equal(result.accepted, ['a@a.example'])
+        self.assert_equal(sorted(result.refused),
+                          ['refused@a.example', 'x@down.example'])
+        self.assert_equal(result.refused['x@down.example'][0], -1)
+        result = mail.send(Message('hello', to='x@down.example'))
+        self.assert_false(result.ok)
+        self.assert_isinstance(result.error, socket.error)
+
+    def test_lookup_mx_errors(self):
+        import types
+        from sender import lookup_mx
+        dns = types.ModuleType('dns')
+        dns.exception = types.ModuleType('dns.exception')
+        dns.resolver = types.ModuleType('dns.resolver')
+        for name in ('Timeout', 'NoAnswer', 'NXDOMAIN', 'NoNameservers'):
+            setattr(dns.resolver, name, type(name, (Exception,), {}))
+        dns.exception.Timeout = dns.resolver.Timeout
+
+        def resolve(domain, rdtype):
+            raise getattr(dns.resolver, domain.split('.')[0])()
+        dns.resolver.resolve = resolve
+        modules = dict((name, sys.modules.get(name)) for name in
+                       ('dns', 'dns.exception', 'dns.resolver'))
+        sys.modules.update({'dns': dns, 'dns.exception': dns.exception,
+                            'dns.resolver': dns.resolver})
+        try:
+            self.assert_equal(lookup_mx('NoAnswer.example'),
+                              [(0, 'NoAnswer.example')])
+            for domain in ('NXDOMAIN', 'NoNameservers', 'Timeout'):
+                self.assert_raises(SenderError, lookup_mx,
+                                   domain + '.example')
+        finally:
+            for name, module in modules.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
+
+    def test_resolver_error(self):
+        mail = self.make_mail()
+        for concurrency in (1, 3):
+            result = mail.send(Message('hello', to=['a@a.example',
+                                                    'x@nx.example',
+                                                    'y@broken.example']),
+                               concurrency=concurrency)
+            self.assert_true(result.ok)
+            self.assert_equal(result.accepted, ['a@a.example'])
+            self.assert_equal(sorted(result.refused),
+                              ['x@nx.example', 'y@broken.example'])
+            self.assert_equal(result.refused['x@nx.example'][0], -1)
+        result = mail.send(Message('hello', to='y@broken.example'))
+        self.assert_false(result.ok)
+        self.assert_isinstance(result.error, ValueError)
+
+    def test_connection_limit(self):
+        import threading
+        self.resolver = lambda domain: [(10, '127.0.0.1')] \
+            if domain == 'a.example' else [(10, 'localhost')]
+        mail = self.make_mail(rate_limiter=RateLimiter(max_connections=1))
+        msg = Message('hello', to=['a@a.example', 'b@b.example'])
+        thread = threading.Thread(target=mail.send, args=(msg,),
+                                  kwargs={'concurrency': 2})
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assert_false(thread.is_alive())
+        self.assert_equal(len(self.server.messages), 2)
+
+    def test_options(self):
+        self.assert_raises(SenderError, self.make_mail, pool_size=2)
+        self.assert_raises(SenderError, self.make_mail, retry=RetryPolicy())
+
+
+class RetryTestCase(ServerTestCase):
+
+    def make_mail(self, **kwargs):
+        kwargs.setdefault('retry', RetryPolicy(max_attempts=3,
+                                               base_delay=0.01))
+        return ServerTestCase.make_mail(self, **kwargs)
+
+    def test_policy(self):
+        policy = RetryPolicy(base_delay=1, max_delay=5, jitter=0)
+        self.assert_equal([policy.delay(i) for i in range(1, 6)],
+                          [1, 2, 4, 5, 5])
+        policy = RetryPolicy(base_delay=1, jitter=0.5)
+        for i in range(20):
+            self.assert_true(0.5 <= policy.delay(1) <= 1)
+        self.assert_true(policy.is_transient(
+            smtplib.SMTPDataError(451, b'busy')))
+        self.assert_true(policy.is_transient(
+            smtplib.SMTPServerDisconnected()))
+        self.assert_true(policy.is_transient(socket.error()))
+        self.assert_false(policy.is_transient(
+            smtplib.SMTPDataError(554, b'rejected')))
+        self.assert_false(policy.is_transient(
+            smtplib.SMTPRecipientsRefused({'a@example.com': (451, b''),
+                                           'b@example.com': (550, b'')})))
+
+    def test_transient(self):
+        self.server.script['DATA'] = ['451 busy']
+        mail = self.make_mail()
+        result = mail.send(Message('hello', to='to@example.com'))
+        self.assert_true(result.ok)
+        self.assert_equal(result.attempts, 2)
+        self.assert_equal(len(self.server.messages), 1)
+
+    def test_permanent(self):
+        self.server.script['DATA'] = ['554 rejected']
+        mail = self.make_mail()
+        result = mail.send(Message('hello', to='to@example.com'))
+        self.assert_false(result.ok)
+        self.assert_isinstance(result.error, smtplib.SMTPDataError)
+        self.assert_equal(result.attempts, 1)
+
+    def test_batch_keeps_flowing(self):
+        mail = self.make_mail()
+        results = mail.send([Message('hello', to='to1@example.com'),
+                             Message('hello', to='refused@example.com'),
+                             Message('hello', to='to2@example.com')])
+        self.assert_equal([r.ok for r in results], [True, False, True])
+        self.assert_equal(results[1].refused,
+                          {'refused@example.com': (550, b'no such user')})
+        self.assert_equal(len(self.server.messages), 2)
+
+    def test_deferred_recipient(self):
+        mail = self.make_mail()
+        result = mail.send(Message('hello', to=['to@example.com',
+                                                'deferred@example.com']))
+        self.assert_true(result.ok)
+        self.assert_equal(result.attempts, 3)
+        self.assert_equal(result.accepted, ['to@example.com'])
+        self.assert_equal(list(result.refused), ['deferred@example.com'])
+        self.assert_equal(self.server.messages[0][1], ['to@example.com'])
+        rcpts = [c for c in self.server.commands
+                 if c.upper().startswith('RCPT')]
+        self.assert_equal(len(rcpts), 4)
+
+    def test_reconnect(self):
+        self.server.script['MAIL'] = ['421 closing']
+        mail = self.make_mail()
+        results = mail.send([Message('hello', to='to1@example.com'),
+                             Message('hello', to='to2@example.com')])
+        self.assert_equal([r.ok for r in results], [True, True])
+        self.assert_equal(results[0].attempts, 2)
+        self.assert_equal(self.server.sessions, 2)
+
+    def test_invalid_message(self):
+        mail = self.make_mail()
+        results = mail.send([Message('hello', to='to1@example.com'),
+                             Message('hello'),
+                             Message('hello', to='to2@example.com')],
+                            concurrency=2)
+        self.assert_equal([r.ok for r in results], [True, False, True])
+        self.assert_isinstance(results[1].error, SenderError)
+        self.assert_equal(results[1].attempts, 1)
+        self.assert_equal(len(self.server.messages), 2)
+
+    def test_concurrency(self):
+        self.server.script['DATA'] = ['451 busy'] * 5
+        mail = self.make_mail()
+        messages = [Message('hello', to='to%d@example.com' % i)
+                    for i in range(20)]
+        results = mail.send(messages, concurrency=4)
+        self.assert_equal([r.message for r in results], messages)
+        self.assert_true(all(r.ok for r in results))
+        self.assert_equal(len(self.server.messages), 20)
+
+
+class PeakRateLimiter(RateLimiter):
+    """Remembers the most connections in use at the same time."""
+
+    peak = 0
+
+    def try_open_connection(self, callback=None):
+        opened = RateLimiter.try_open_connection(self, callback)
+        self.peak = max(self.peak, self.connections)
+        return opened
+
+    def open_connection(self):
+        RateLimiter.open_connection(self)
+        self.peak = max(self.peak, self.connections)
+
+
+class RateLimiterTestCase(ServerTestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(100, burst=2)
+        self.assert_equal(bucket.reserve(), 0)
+        self.assert_equal(bucket.reserve(), 0)
+        self.assert_true(0.005 < bucket.reserve() <= 0.01)
+        self.assert_true(0.015 < bucket.reserve() <= 0.02)
+
+    def test_adapt(self):
+        limiter = RateLimiter(messages_per_second=100,
+                              recipients_per_second=1000)
+        limiter.feedback([250])
+        self.assert_equal(limiter.rates, (100, 1000))
+        limiter.feedback([250, 451])
+        self.assert_equal(limiter.rates, (50, 500))
+        for i in range(10):
+            limiter.feedback([421])
+        self.assert_equal(limiter.rates, (5, 50))
+        limiter.feedback([250])
+        self.assert_equal(limiter.rates, (10, 100))
+        self.assert_equal(RateLimiter().rates, (None, None))
+
+    def test_connections(self):
+        limiter = RateLimiter(max_connections=1)
+        woken = []
+        self.assert_true(limiter.try_open_connection())
+        self.assert_false(limiter.try_open_connection(
+            lambda: woken.append(1)))
+        limiter.close_connection()
+        self.assert_equal(woken, [1])
+        self.assert_true(limiter.try_open_connection())
+
+    def test_send(self):
+        import time
+        limiter = PeakRateLimiter(messages_per_second=100, burst=1,
+                                  max_connections=2)
+        mail = self.make_mail(rate_limiter=limiter)
+        messages = [Message('hello', to='to@example.com') for i in range(6)]
+        start = time.time()
+        mail.send(messages, concurrency=4)
+        self.assert_true(time.time() - start >= 0.05)
+        self.assert_equal(limiter.peak, 2)
+        self.assert_equal(limiter.connections, 0)
+
+    def test_throttled(self):
+        limiter = RateLimiter(messages_per_second=1000)
+        mail = self.make_mail(rate_limiter=limiter)
+        mail.send(Message('hello', to=['to@example.com',
+                                       'deferred@example.com']))
+        self.assert_equal(limiter.rates, (500, None))
+        self.server.script['DATA'] = ['451 busy']
+        self.assert_raises(smtplib.SMTPDataError, mail.send,
+                           Message('hello', to='to@example.com'))
+        self.assert_equal(limiter.rates, (250, None))
+        self.assert_equal(limiter.connections, 0)
+
+
+class HostListTestCase(ServerTestCase):
+
+    def free_port(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def make_mail(self, hosts, **kwargs):
+        mail = Mail(hosts, fromaddr='from@example.com', **kwargs)
+        self.mails.append(mail)
+        return mail
+
+    def test_endpoints(self):
+        hosts = HostList(['a', ('b', 2525), ('c', 25, 3)], port=587)
+        self.assert_equal([(e.host, e.port, e.weight)
+                           for e in hosts.endpoints],
+                          [('a', 587, 1), ('b', 2525, 1), ('c', 25, 3)])
+        self.assert_equal(len(HostList('a')), 1)
+        self.assert_equal(len(HostList(('a', 25))), 1)
+
+    def test_weights(self):
+        hosts = HostList([('a', 25, 1), ('b', 25, 9)])
+        first = [hosts.candidates()[0].host for i in range(1000)]
+        self.assert_true(first.count('b') > 800)
+        self.assert_true(first.count('a') > 0)
+
+    def test_cooldown(self):
+        hosts = HostList(['a', 'b'], cooldown=60)
+        a, b = hosts.endpoints
+        hosts.mark_down(a)
+        for i in range(10):
+            self.assert_equal(hosts.candidates(), [b, a])
+        hosts.mark_down(b)
+        self.assert_equal(hosts.candidates(), [a, b])
+        hosts.mark_up(b)
+        self.assert_equal(hosts.candidates(), [b, a])
+
+    def test_mx(self):
+        looked_up = []
+
+        def resolver(domain):
+            looked_up.append(domain)
+            return [(20, 'mx2.' + domain), (10, 'mx1.' + domain)]
+
+        hosts = HostList('example.com', resolve_mx=True, resolver=resolver)
+        self.assert_equal([e.host for e in hosts.candidates()],
+                          ['mx1.example.com', 'mx2.example.com'])
+        hosts.candidates()
+        self.assert_equal(looked_up, ['example.com'])
+
+    def test_failover(self):
+        mail = self.make_mail([('127.0.0.1', self.free_port()),
+                               ('127.0.0.1', self.server.port)])
+        dead, alive = mail.hosts.endpoints
+        # so that the dead host is tried first
+        mail.hosts.mark_down(alive)
+        for i in range(5):
+            mail.send_message('hello', to='to@example.com')
+        self.assert_equal(len(self.server.messages), 5)
+        self.assert_equal(dead.failures, 1)
+        self.assert_equal(alive.failures, 0)
+
+    def test_all_down(self):
+        mail = self.make_mail([('127.0.0.1', self.free_port())])
+        self.assert_raises(socket.error, mail.send_message, 'hello',
+                           to='to@example.com')
+
+    def test_in_flight(self):
+        other = SMTPServer()
+        other.start()
+        try:
+            mail = self.make_mail([('127.0.0.1', self.server.port),
+                                   ('127.0.0.1', other.port)])
+            first, second = mail.hosts.endpoints
+            mail.hosts.mark_down(second)
+            self.server.script['MAIL'] = ['421 closing']
+            result = mail.send_message('hello', to='to@example.com')
+            self.assert_equal(result.accepted, ['to@example.com'])
+            self.assert_equal(self.server.messages, [])
+            self.assert_equal(len(other.messages), 1)
+            self.assert_equal(first.failures, 1)
+        finally:
+            other.stop()
+
+
+class RecordingMetrics(Metrics):
+    """Keeps every measurement."""
+
+    def __init__(self):
+        self.timings = []
+        self.counters = {}
+
+    def timing(self, phase, seconds, host=None):
+        self.timings.append((phase, host))
+
+    def increment(self, name, value=1, host=None):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+class MetricsTestCase(ServerTestCase):
+
+    def test_phases(self):
+        metrics = RecordingMetrics()
+        mail = self.make_mail(metrics=metrics, username='user',
+                              password='pass')
+        mail.send_message('hello', to=['to@example.com',
+                                       'refused@example.com'])
+        self.assert_equal([phase for phase, host in metrics.timings],
+                          ['connect', 'auth', 'render', 'transmit'])
+        self.assert_equal(set(host for phase, host in metrics.timings),
+                          set(['127.0.0.1']))
+        bytes_sent = metrics.counters.pop('bytes')
+        self.assert_equal(bytes_sent, len(self.server.messages[0][2]) + 3)
+        self.assert_equal(metrics.counters, {
+            'connections.opened': 1, 'messages.sent': 1,
+            'recipients.accepted': 1, 'recipients.refused': 1})
+
+    def test_failed(self):
+        metrics = RecordingMetrics()
+        mail = self.make_mail(metrics=metrics)
+        self.assert_raises(smtplib.SMTPRecipientsRefused, mail.send_message,
+                           'hello', to='refused@example.com')
+        self.assert_equal(metrics.counters['messages.failed'], 1)
+        self.assert_not_in('messages.sent', metrics.counters)
+
+    def test_statsd(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(5)
+        try:
+            metrics = StatsdMetrics(port=sock.getsockname()[1],
+                                    per_host=True)
+            metrics.timing('connect', 0.0125, 'smtp.example.com')
+            metrics.increment('bytes', 42)
+            self.assert_equal(sock.recv(1024),
+                              b'sender.smtp_example_com.connect:12.500|ms')
+            self.assert_equal(sock.recv(1024), b'sender.bytes:42|c')
+        finally:
+            sock.close()
+            metrics.sock.close()
+
+    @unittest.skipIf(AsyncMail is None, 'asyncio is not available')
+    def test_async(self):
+        metrics = RecordingMetrics()
+        mail = AsyncMail('127.0.0.1', port=self.server.port,
+                         fromaddr='from@example.com', metrics=metrics)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(mail.send_message('hello',
+                                                      to='to@example.com'))
+        finally:
+            loop.close()
+        self.assert_equal([phase for phase, host in metrics.timings],
+                          ['connect', 'render', 'transmit'])
+        self.assert_equal(metrics.counters['messages.sent'], 1)
+
+
+class SpoolTestCase(ServerTestCase):
+
+    def setup(self):
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    @property
+    def path(self):
+        import os
+        return os.path.join(self.tempdir, 'spool.db')
+
+    def wait(self, spool):
+        import time
+        for i in range(500):
+            if spool.depth() == {'pending': 0, 'sending': 0, 'failed': 0}:
+                return
+            time.sleep(0.01)
+        raise AssertionError('spool not drained: %r' % spool.depth())
+
+    def test_enqueue(self):
+        mail = self.make_mail(spool_path=self.path, spool_workers=2)
+        for i in range(10):
+            mail.enqueue(Message('hello', to='to%d@example.com' % i))
+        self.wait(mail.spool)
+        self.assert_equal(mail.spool.sent, 10)
+        self.assert_equal(len(self.server.messages), 10)
+
+    def test_no_spool(self):
+        mail = self.make_mail()
+        self.assert_raises(SenderError, mail.enqueue,
+                           Message('hello', to='to@example.com'))
+
+    def test_failures(self):
+        mail = self.make_mail(spool_path=self.path, spool_workers=0)
+        mail.enqueue(Message('hello', to='refused@example.com'))
+        mail.enqueue(Message('hello', to='to@example.com'))
+        self.assert_equal(mail.spool.process(), 2)
+        self.assert_equal(mail.spool.depth(),
+                          {'pending': 0, 'sending': 0, 'failed': 1})
+        [(id, message, error)] = mail.spool.failures()
+        self.assert_equal(message.to_addrs, ['refused@example.com'])
+        self.assert_in('SMTPRecipientsRefused', error)
+
+    def test_transient(self):
+        import time
+        self.server.script['DATA'] = ['451 busy']
+        mail = self.make_mail(spool_path=self.path, spool_workers=0,
+                              retry=RetryPolicy(max_attempts=2,
+                                                base_delay=0.05, jitter=0))
+        mail.enqueue(Message('hello', to='to@example.com'))
+        mail.enqueue(Message('hello', to='deferred@example.com'))
+        self.assert_equal(mail.spool.process(), 2)
+        self.assert_equal(mail.spool.depth()['pending'], 2)
+        # not due yet
+        self.assert_equal(mail.spool.process(), 0)
+        time.sleep(0.1)
+        self.assert_equal(mail.spool.process(), 2)
+        self.assert_equal(mail.spool.depth(),
+                          {'pending': 0, 'sending': 0, 'failed': 1})
+        self.assert_equal(len(self.server.messages), 1)
+        [(id, message, error)] = mail.spool.failures()
+        self.assert_equal(message.to_addrs, ['deferred@example.com'])
+
+    def test_upgrade(self):
+        import sqlite3
+        db = sqlite3.connect(self.path)
+        db.execute(
+            'CREATE TABLE spool ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, state INTEGER NOT NULL, '
+            'fromaddr TEXT, to_addrs TEXT, mail_options TEXT, '
+            'rcpt_options TEXT, data BLOB, error TEXT, created REAL)')
+        db.execute("INSERT INTO spool (state, fromaddr, to_addrs, "
+                   "mail_options, rcpt_options, data) VALUES "
+                   "(0, 'from@example.com', '[\"to@example.com\"]', '[]', "
+                   "'[]', X'68656c6c6f0a')")
+        db.commit()
+        db.close()
+        mail = self.make_mail(spool_path=self.path, spool_workers=0)
+        self.assert_equal(mail.spool.process(), 1)
+        self.assert_equal(len(self.server.messages), 1)
+
+    def test_recovery(self):
+        mail = self.make_mail(spool_path=self.path, spool_workers=0)
+        mail.enqueue(Message('hello', to='to@example.com'))
+        # claimed, then the process dies
+        mail.spool._claim()
+        self.assert_equal(mail.spool.depth()['sending'], 1)
+        mail.close()
+        # still leased
+        mail = self.make_mail(spool_path=self.path, spool_workers=0)
+        self.assert_equal(mail.spool.process(), 0)
+        spool = Spool(mail, self.path, workers=1, lease=0)
+        try:
+            self.wait(spool)
+        finally:
+            spool.close()
+        self.assert_equal(len(self.server.messages), 1)
+
+    def test_shared_file(self):
+        first = self.make_mail(spool_path=self.path, spool_workers=0)
+        for i in range(3):
+            first.enqueue(Message('hello', to='to%d@example.com' % i))
+        batch = first.spool._claim()
+        # one more process opens the file while the first one sends
+        second = self.make_mail(spool_path=self.path, spool_workers=0)
+        self.assert_equal(second.spool.process(), 0)
+        self.assert_equal(second.spool.depth()['sending'], 3)
+        first.spool._deliver(batch)
+        self.assert_equal(len(self.server.messages), 3)
+
+    def test_broken_connection(self):
+        mail = FailingMail('127.0.0.1', port=self.server.port,
+                           fromaddr='from@example.com',
+                           retry=RetryPolicy(max_attempts=2, base_delay=0))
+        self.mails.append(mail)
+        mail.failures = 1
+        mail.error = SenderError('no SMTP server to connect to')
+        spool = Spool(mail, self.path, workers=1, poll_interval=0.01)
+        try:
+            spool.put(Message('hello', to='to@example.com',
+                              fromaddr='from@example.com'))
+            self.wait(spool)
+            # the worker lived through the error
+            spool.put(Message('hello', to='to@example.com',
+                              fromaddr='from@example.com'))
+            self.wait(spool)
+        finally:
+            spool.close()
+        self.assert_equal(len(self.server.messages), 2)
+        self.assert_isinstance(spool.last_error, SenderError)
+
+    def test_dropped_connection(self):
+        mail = FailingMail('127.0.0.1', port=self.server.port,
+                           fromaddr='from@example.com', spool_path=self.path,
+                           spool_workers=0,
+                           retry=RetryPolicy(max_attempts=2, base_delay=0))
+        self.mails.append(mail)
+        mail.failures = 2
+        mail.on_send = True
+        mail.error = smtplib.SMTPServerDisconnected('dropped')
+        mail.enqueue(Message('hello', to='to@example.com'))
+        self.assert_equal(mail.spool.process(), 1)
+        self.assert_equal(mail.spool.depth()['pending'], 1)
+        self.assert_equal(mail.spool.process(), 1)
+        # every try counts, the message is not tried forever
+        self.assert_equal(mail.spool.depth(),
+                          {'pending': 0, 'sending': 0, 'failed': 1})
+
+    def test_server_down(self):
+        mail = Mail('127.0.0.1', port=1, fromaddr='from@example.com',
+                    spool_path=self.path, spool_workers=0)
+        self.mails.append(mail)
+        mail.enqueue(Message('hello', to='to@example.com'))
+        self.assert_equal(mail.spool.process(), 1)
+        self.assert_equal(mail.spool.depth()['pending'], 1)
+
+
+class RenderProcessesTestCase(ServerTestCase):
+
+    def test_pickle(self):
+        import pickle
+        msg = Message('hello', fromaddr='from@example.com',
+                      to='to@example.com', body='hello', html='<p>hi</p>')
+        msg.attach_attachment('test.txt', 'text/plain', b'this is test')
+        data = msg.as_bytes()
+        copy = pickle.loads(pickle.dumps(msg))
+        self.assert_true(copy._rendered is None)
+        self.assert_equal(copy.message_id, msg.message_id)
+        self.assert_same_mime(copy.as_bytes(), data)
+
+    def test_render_processes(self):
+        if sys.version_info[0] == 2:
+            return
+        import io
+        mail = self.make_mail()
+        messages = []
+        for i in range(6):
+            msg = Message('hello %d' % i, to='to%d@example.com' % i,
+                          body='hello', html='<p>hello</p>')
+            msg.attach_attachment('test.txt', 'text/plain', b'test %d' % i)
+            messages.append(msg)
+        # can not be pickled, rendered while it is sent
+        messages.append(Message('view', to='view@example.com', attachments=[
+            Attachment('test.txt', 'text/plain', memoryview(b'view'))]))
+        messages.append(Message('stream', to='stream@example.com',
+                                attachments=[Attachment(
+                                    'test.txt', 'text/plain',
+                                    io.BytesIO(b'stream'))]))
+        results = mail.send(iter(messages), concurrency=2,
+                            render_processes=2)
+        self.assert_equal([r.message for r in results], messages)
+        self.assert_equal(len(self.server.messages), 8)
+        received = dict((rcpts[0], data)
+                        for fromaddr, rcpts, data in self.server.messages)
+        for i, msg in enumerate(messages[:6]):
+            self.assert_equal(
+                received['to%d@example.com' % i].replace(b'\r\n', b'\n'),
+                msg.as_bytes())
+
+    def test_single_message(self):
+        import sender
+        mail = self.make_mail()
+        msg = Message('hello', to='to@example.com', body='hello')
+        executor = sender.ProcessPoolExecutor
+        sender.ProcessPoolExecutor = None
+        try:
+            self.assert_raises(SenderError, mail.send, msg,
+                               render_processes=2)
+        finally:
+            sender.ProcessPoolExecutor = executor
+        if sys.version_info[0] == 2:
+            return
+        result = mail.send(msg, render_processes=2)
+        self.assert_equal(result.accepted, ['to@example.com'])
+
+    def test_send_merge(self):
+        if sys.version_info[0] == 2:
+            return
+        mail = self.make_mail()
+        template = MessageTemplate('hello $name', body='hi $name')
+        rows = [{'to': 'to%d@example.com' % i, 'name': 'n%d' % i}
+                for i in range(5)]
+        results = mail.send_merge(template, rows, render_processes=2)
+        self.assert_equal([r.accepted for r in results],
+                          [[row['to']] for row in rows])
+
+
+class StreamTestCase(ServerTestCase):
+
+    def test_stream(self):
+        mail = self.make_mail()
+        messages = [Message('hello', to='to%d@example.com' % i)
+                    for i in range(10)]
+        results = list(mail.stream(iter(messages), concurrency=3))
+        self.assert_equal(len(results), 10)
+        self.assert_equal(set(r.message for r in results), set(messages))
+        self.assert_true(all(r.ok for r in results))
+        self.assert_equal(len(self.server.messages), 10)
+
+    def test_window(self):
+        mail = self.make_mail()
+        taken = []
+
+        def messages():
+            for i in range(20):
+                taken.append(i)
+                yield Message('hello', to='to%d@example.com' % i)
+
+        stream = mail.stream(messages(), concurrency=2, window=3)
+        for i, result in enumerate(stream):
+            self.assert_true(result.ok)
+            self.assert_true(len(taken) <= i + 3)
+        self.assert_equal(len(taken), 20)
+
+    def test_factories(self):
+        mail = self.make_mail()
+        made = []
+
+        def factory(i):
+            def make():
+                made.append(i)
+                return Message('hello', to='to%d@example.com' % i)
+            return make
+
+        stream = mail.stream((factory(i) for i in range(5)), window=1)
+        first = next(stream)
+        self.assert_equal(made, [0])
+        results = [first] + list(stream)
+        self.assert_equal(made, list(range(5)))
+        self.assert_equal([r.accepted for r in results],
+                          [['to%d@example.com' % i] for i in range(5)])
+
+    def test_failures(self):
+        mail = self.make_mail()
+        results = list(mail.stream([
+            Message('hello', to='to1@example.com'),
+            Message('hello', to='refused@example.com'),
+            Message('hello', to='to2@example.com')]))
+        self.assert_equal([r.ok for r in results], [True, False, True])
+        self.assert_isinstance(results[1].error,
+                               smtplib.SMTPRecipientsRefused)
+        self.assert_equal(len(self.server.messages), 2)
+
+    def test_invalid(self):
+        def broken():
+            raise SenderError('no such row')
+
+        for render_processes in (None, 2):
+            if render_processes and sys.version_info[0] == 2:
+                continue
+            mail = self.make_mail()
+            sent = len(self.server.messages)
+            messages = [Message('hello', to='to1@example.com'), Message(),
+                        broken, Message('hello', to='to2@example.com')]
+            results = list(mail.stream(messages, concurrency=2,
+                                       render_processes=render_processes))
+            self.assert_equal(len(results), 4)
+            failed = [r for r in results if not r.ok]
+            self.assert_equal(sorted(id(r.message) for r in failed),
+                              sorted([id(messages[1]), id(broken)]))
+            for result in failed:
+                self.assert_isinstance(result.error, SenderError)
+            self.assert_equal(len(self.server.messages), sent + 2)
+
+    def test_retry(self):
+        self.server.script['DATA'] = ['451 busy']
+        mail = self.make_mail(retry=RetryPolicy(max_attempts=3,
+                                                base_delay=0.01))
+        [result] = mail.stream([Message('hello', to='to@example.com')])
+        self.assert_true(result.ok)
+        self.assert_equal(result.attempts, 2)
+
+    def test_close(self):
+        mail = self.make_mail()
+        taken = []
+
+        def messages():
+            for i in range(100):
+                taken.append(i)
+                yield Message('hello', to='to%d@example.com' % i)
+
+        stream = mail.stream(messages(), concurrency=2, window=4)
+        next(stream)
+        stream.close()
+        self.assert_true(len(taken) <= 5)
+        self.assert_true(len(self.server.messages) <= 5)
+
+    def test_error(self):
+        mail = self.make_mail()
+
+        def messages():
+            yield Message('hello', to='to@example.com')
+            raise ValueError('broken')
+
+        self.assert_raises(ValueError, list, mail.stream(messages()))
+        mail = self.make_mail(direct=True)
+        self.assert_raises(SenderError, list, mail.stream([]))
+
+
+class ConnectionPoolTestCase(ServerTestCase):
+
+    def test_no_pool(self):
+        mail = self.make_mail()
+        self.assert_equal(mail.pool, None)
+        mail.send_message('one', to='to@example.com')
+        mail.send_message('two', to='to@example.com')
+        self.assert_equal(self.server.sessions, 2)
+        self.assert_equal(len(self.server.messages), 2)
+
+    def test_reuse_session(self):
+        mail = self.make_mail(pool_size=2)
+        for i in range(3):
+            mail.send_message('hello', to='to@example.com')
+        self.assert_equal(self.server.sessions, 1)
+        self.assert_equal(len(self.server.messages), 3)
+        self.assert_equal(mail.pool.idle, 1)
+        self.assert_in('noop', self.server.commands)
+        mail.close()
+        self.assert_equal(mail.pool.size, 0)
+
+    def test_replace_dead_session(self):
+        mail = self.make_mail(pool_size=1)
+        mail.send_message('hello', to='to@example.com')
+        mail.pool._idle[0][0].close()
+        mail.send_message('hello', to='to@example.com')
+        self.assert_equal(self.server.sessions, 2)
+        self.assert_equal(mail.pool.size, 1)
+
+    def test_idle_timeout(self):
+        mail = self.make_mail(pool_size=1, pool_idle_timeout=0)
+        mail.send_message('hello', to='to@example.com')
+        mail.send_message('hello', to='to@example.com')
+        self.assert_equal(self.server.sessions, 2)
+
+    def test_bounded(self):
+        mail = self.make_mail(pool_size=1, pool_timeout=0.01)
+        with mail.connection:
+            self.assert_raises(SenderError, mail.pool.get)
+        self.assert_equal(mail.pool.size, 1)
+
+    def test_threads(self):
+        mail = self.make_mail(pool_size=3)
+        threads = [threading.Thread(target=mail.send_message,
+                                    args=('hello',),
+                                    kwargs={'to': 'to@example.com'})
+                   for i in range(12)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assert_equal(len(self.server.messages), 12)
+        self.assert_true(self.server.sessions <= 3)
+
+
+@unittest.skipIf(AsyncMail is None, 'asyncio is not available')
+class AsyncMailTestCase(ServerTestCase):
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def make_mail(self, **kwargs):
+        kwargs.setdefault('fromaddr', 'from@example.com')
+        return AsyncMail('127.0.0.1', port=self.server.port, **kwargs)
+
+    def test_send(self):
+        mail = self.make_mail(username='user', password='pass')
+        msg = Message('hello', to=['to@example.com', 'refused@example.com'],
+                      body='.leading period')
+        result = self.run_async(mail.send(msg))
+        self.assert_equal(result.accepted, ['to@example.com'])
+        self.assert_equal(list(result.refused), ['refused@example.com'])
+        self.assert_equal(len(self.server.messages), 1)
+        mailfrom, rcpts, data = self.server.messages[0]
+        self.assert_equal(mailfrom, 'from@example.com')
+        self.assert_equal(rcpts, ['to@example.com'])
+        self.assert_in(b'\r\n..leading period', data)
+        self.assert_in('AUTH PLAIN AHVzZXIAcGFzcw==', self.server.commands)
+
+    def send_all(self, mail, messages):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(
+                asyncio.gather(*[mail.send(m) for m in messages]))
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_send_many(self):
+        mail = self.make_mail()
+        messages = [Message('hello %d' % i, to='to@example.com')
+                    for i in range(10)]
+        self.send_all(mail, messages)
+        self.assert_equal(len(self.server.messages), 10)
+        self.assert_equal(self.server.sessions, 10)
+
+    def test_max_connections(self):
+        self.server.max_sessions = 2
+        mail = self.make_mail(max_connections=2)
+        messages = [Message('hello %d' % i, to='to@example.com')
+                    for i in range(10)]
+        results = self.send_all(mail, messages)
+        self.assert_true(all(r.ok for r in results))
+        self.assert_equal(len(self.server.messages), 10)
+        # one more event loop gets its own semaphore
+        self.send_all(mail, messages)
+        self.assert_equal(len(self.server.messages), 20)
+
+    def test_stream(self):
+        import io
+        mail = self.make_mail()
+        msg = Message('hello', to='to@example.com', body='hello')
+        msg.attach(Attachment('data.bin', 'application/bin',
+                              io.BytesIO(b'x' * 100000)))
+        self.run_async(mail.send(msg))
+        self.assert_in(b'eHh4eHh4', self.server.messages[0][2])
+
+    def test_no_pipelining(self):
+        self.server.extensions = ['8BITMIME']
+        mail = self.make_mail()
+        self.run_async(mail.send_message('hello', to='to@example.com'))
+        self.assert_equal(len(self.server.messages), 1)
+
+    def test_refused(self):
+        import smtplib
+        mail = self.make_mail()
+        msg = Message('hello', to='refused@example.com')
+        self.assert_raises(smtplib.SMTPRecipientsRefused, self.run_async,
+                           mail.send(msg))
+        self.assert_equal(self.server.messages, [])
+
+    def test_refused_no_pipelining(self):
+        import smtplib
+        self.server.extensions = ['8BITMIME']
+        mail = self.make_mail()
+        msg = Message('hello', to='refused@example.com')
+        self.assert_raises(smtplib.SMTPRecipientsRefused, self.run_async,
+                           mail.send(msg))
+        self.assert_equal([c for c in self.server.commands
+                           if c.upper() == 'DATA'], [])
+
+    def test_reset_disconnected(self):
+        import smtplib
+        # the refusal is raised, not the connection closed before RSET
+        self.server.script['RSET'] = ['']
+        mail = self.make_mail()
+        msg = Message('hello', to='refused@example.com')
+        self.assert_raises(smtplib.SMTPRecipientsRefused, self.run_async,
+                           mail.send(msg))
+
+    def test_no_pool(self):
+        self.assert_raises(SenderError, self.make_mail, pool_size=2)
+
+    def test_send_merge(self):
+        mail = self.make_mail()
+        template = MessageTemplate('Hello $name', body='Dear $name')
+        rows = [{'to': 'a@example.com', 'name': 'A'},
+                {'to': 'b@example.com', 'name': 'B'}]
+        results = self.run_async(mail.send_merge(template, rows))
+        self.assert_equal(len(results), 2)
+        self.assert_equal(len(self.server.messages), 2)
+        self.assert_in(b'Dear B', self.server.messages[1][2])
+
+    def test_no_stream(self):
+        mail = self.make_mail()
+        self.assert_raises(SenderError, mail.stream,
+                           [Message('hello', to='to@example.com')])
+
+    def test_no_spool(self):
+        import os
+        import shutil
+        import tempfile
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'spool.db')
+            self.assert_raises(SenderError, self.make_mail, spool_path=path)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_failover(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead = ('127.0.0.1', sock.getsockname()[1])
+        sock.close()
+        mail = AsyncMail([dead, ('127.0.0.1', self.server.port)],
+                         fromaddr='from@example.com')
+        mail.hosts.mark_down(mail.hosts.endpoints[1])
+        self.run_async(mail.send_message('hello', to='to@example.com'))
+        self.assert_equal(len(self.server.messages), 1)
+        self.assert_equal(mail.hosts.endpoints[0].failures, 1)
+
+    def test_rate_limiter(self):
+        limiter = PeakRateLimiter(messages_per_second=1000,
+                                  max_connections=2)
+        mail = self.make_mail(rate_limiter=limiter)
+        messages = [Message('hello %d' % i, to='to@example.com')
+                    for i in range(6)]
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(
+                asyncio.gather(*[mail.send(m) for m in messages]))
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+        self.assert_equal(len(self.server.messages), 6)
+        self.assert_equal(limiter.peak, 2)
+        self.assert_equal(limiter.connections, 0)
+
+
 class SenderTestCase(BaseTestCase):
     pass
 
@@ -239,6 +2072,22 @@ def suite():
     suite.addTest(unittest.makeSuite(MailTestCase))
     suite.addTest(unittest.makeSuite(MessageTestCase))
     suite.addTest(unittest.makeSuite(AttachmentTestCase))
+    suite.addTest(unittest.makeSuite(FastRenderTestCase))
+    suite.addTest(unittest.makeSuite(ParallelSendTestCase))
+    suite.addTest(unittest.makeSuite(PipeliningTestCase))
+    suite.addTest(unittest.makeSuite(MessageTemplateTestCase))
+    suite.addTest(unittest.makeSuite(MessageBatchTestCase))
+    suite.addTest(unittest.makeSuite(RecipientChunkTestCase))
+    suite.addTest(unittest.makeSuite(DirectDeliveryTestCase))
+    suite.addTest(unittest.makeSuite(RetryTestCase))
+    suite.addTest(unittest.makeSuite(RateLimiterTestCase))
+    suite.addTest(unittest.makeSuite(HostListTestCase))
+    suite.addTest(unittest.makeSuite(MetricsTestCase))
+    suite.addTest(unittest.makeSuite(SpoolTestCase))
+    suite.addTest(unittest.makeSuite(RenderProcessesTestCase))
+    suite.addTest(unittest.makeSuite(StreamTestCase))
+    suite.addTest(unittest.makeSuite(ConnectionPoolTestCase))
+    suite.addTest(unittest.makeSuite(AsyncMailTestCase))
     suite.addTest(unittest.makeSuite(SenderTestCase))
     return suite
 